@@ -1,34 +1,131 @@
 import streamlit as st
-import pandas as pd
 import os, sys
+import hashlib
+from io import BytesIO
 current_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_path)
-from stat_functions import *
+from instrument import collect, configure_logging
+from jobs import new_registry, submit
+
+#stage timings go to stderr as json lines
+configure_logging()
+
+#how many uploads/results each cache keeps. The least recently used entry is evicted first.
+CACHE_ENTRIES = 8
+
+#everything below is cached by the hash of the uploaded bytes, so reruns (changing the plot type,
+#switching back to a chemical) reuse earlier work instead of recomputing it.
+@st.cache_resource(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_data(file_hash, file_name, _data):
+    #the upload as a Dataset, sorted and indexed once. It is shared between reruns rather than copied, callers must not modify it.
+    #read_upload also keeps a columnar copy on disk, so the file is only parsed once across restarts and sessions.
+    df = read_upload(_data, file_name, file_hash)
+    check_columns(df.columns)
+    return Dataset(df)
+
+def chemical_data(data, chemical):
+    #(metal, metal_data) for every chemical going into the workbook
+    if chemical == 'All':
+        return data.groups('CHEMICAL_NAME')
+    return [(chemical, data.subset(CHEMICAL_NAME=chemical))]
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def cached_stats(file_hash, chemical, _data):
+    if chemical == 'All':
+        return get_all_stats(_data)
+    return {chemical: get_metal_stats(_data, chemical)}
+
+@st.cache_resource(max_entries=CACHE_ENTRIES, show_spinner=False)
+def chart_cache(file_hash):
+    #workbook charts of one upload, each rendered once and shared by every workbook built from the upload
+    return {}
+
+def workbook_charts(file_hash, chemical, data):
+    #render every chart in the workbook in parallel, except those already rendered for another workbook
+    return render_charts([job for metal, metal_data in chemical_data(data, chemical) for job in sheet_chart_jobs(metal_data)], cache=chart_cache(file_hash))
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def cached_workbook(file_hash, chemical, _data, _stats, _images):
+    #the workbook is assembled into a BytesIO, so concurrent sessions never share output files
+    data = _data if chemical == 'All' else _data.subset(CHEMICAL_NAME=chemical)
+    return build_workbook(data, BytesIO(), _stats, _images).getvalue()
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def cached_plot(file_hash, chemical, plot_type, dpi, _metal_data):
+    #the on screen plot, at a resolution for the screen rather than for print
+    if plot_type == 'Scatter':
+        return scatter(_metal_data, chemical, True, dpi=dpi)[chemical].getvalue()
+    elif plot_type == 'Line':
+        return siteLineChart(_metal_data, chemical, dpi=dpi)[f'{chemical}_site_line'].getvalue()
+    elif plot_type == 'Scatter by Site':
+        return siteScatter(_metal_data, chemical, dpi=dpi)[f'{chemical}_site_scatter'].getvalue()
+
+@st.cache_resource
+def job_registry():
+    #one registry for every session, so users asking for the same workbook share one job
+    return new_registry(max_finished=CACHE_ENTRIES)
+
+def all_workbook(data, charts, progress, add_file):
+    return build_workbook(data, BytesIO(), progress=progress, chart_cache=charts).getvalue()
+
+def all_zip(data, split, progress, add_file):
+    #each workbook is also kept in the job as it is finished, so it can be downloaded while the others are still building
+    return build_zip(data, BytesIO(), split, progress=progress, on_file=add_file).getvalue()
+
+#how the 'All' download is packaged: (build_zip split or None for a single workbook, download file name)
+ALL_OUTPUTS = {
+    'One workbook': (None, 'stats.xlsx'),
+    'Zip, one workbook per chemical': ('chemical', 'stats.zip'),
+    'Zip, one workbook per sample type': ('loc_type', 'stats.zip'),
+}
+
+JOB_STEPS = {'queued': 'Waiting for a free worker', 'stats': 'Calculating statistics: chemical', 'charts': 'Rendering charts: chemical',
+             'sheets': 'Writing sheets: chemical', 'workbooks': 'Building workbooks: workbook'}
+
+@st.fragment(run_every=1)
+def job_progress(job):
+    #redrawn every second while the job runs. Once it is done the whole page reruns to show the result.
+    if job['future'].done():
+        st.rerun()
+    text = f"{JOB_STEPS[job['step']]} {job['done']} of {job['total']}"
+    if job['chemical'] and job['done'] < job['total']:
+        text += f" ({job['chemical']})"
+    st.progress(job['done'] / job['total'] if job['total'] else 0.0, text=text)
+    #workbooks that are already done. Downloading one doesn't rerun the page, the job keeps going either way.
+    for name, contents in list(job['files']):
+        st.download_button(f"Download {name}", contents, name, key=f'file-{name}', on_click='ignore')
 
 uploaded_file = st.file_uploader("Upload Files", type=["csv", "xlsx"])
 msg = st.empty()
 button = st.empty()
-
-#we need a files folder. Make if it doesn't exist
-try: 
-    if not os.path.exists('files'):
-        os.makedirs('files')
-except Exception as e:
-    st.warning('Error creating files folder.')
-    st.error(e)
-    st.stop()
+diagnostics = st.sidebar.checkbox("Show diagnostics", help="Time, rows and (with STATS_TRACE_MEMORY=1) peak memory of each step on this run")
 
 if not uploaded_file:
     msg.info("Please upload a file containing raw sample data")
     st.stop()
 
+#pandas and the data modules are imported once there is a file, so the upload widget shows without waiting for them.
+#The functions above only use these names when they are called.
+import pandas as pd
+from ingest import REQUIRED_COLS, MissingColumns, check_columns, read_upload
+from dataset import Dataset
+from stat_functions import PREVIEW_DPI, build_workbook, build_zip, get_all_stats, get_metal_stats, render_charts, scatter, sheet_chart_jobs, siteLineChart, siteScatter
+
+#hash each upload once, not on every rerun
+if st.session_state.get('upload_id') != uploaded_file.file_id:
+    st.session_state['upload_hash'] = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    st.session_state['upload_id'] = uploaded_file.file_id
+file_hash = st.session_state['upload_hash']
+
 msg.info("Reading File...")
 #check file type and read into pandas
-try: 
-    if uploaded_file.name.endswith(".csv"):
-        df = pd.read_csv(uploaded_file)
-    else:
-        df = pd.read_excel(uploaded_file)
+try:
+    with collect() as records:
+        data = load_data(file_hash, uploaded_file.name, uploaded_file.getvalue())
+except MissingColumns as e:
+    #get column names and verify we have what we need.
+    msg.warning(str(e))
+    st.stop()
 except Exception as e:
     msg.warning("Error reading file. Please ensure it is a valid csv or excel file")
     st.error(e)
@@ -36,69 +133,77 @@ except Exception as e:
 msg.write("")
 # st.write(df.head())
 
-#get column names and verify we have what we need.
-required_cols = ['LOC_ID', 'LOC_TYPE', 'LOC_SUBTYPE', 'CHEMICAL_NAME', 'REPORT_RESULT_VALUE', 'REPORT_RESULT_UNIT', 'SAMPLE_DATE']
-col_names = df.columns
-if not set(required_cols).issubset(col_names):
-    msg.warning("Missing required columns: " + ", ".join(set(required_cols) - set(col_names)))
-    st.stop()
-
-df['SAMPLE_DATE'] = pd.to_datetime(df['SAMPLE_DATE'])#, format='%m/%d/%Y')
-df['SAMPLE_YEAR'] = df['SAMPLE_DATE'].dt.year
+required_cols = REQUIRED_COLS
 
 #get unique metals
-metals = df['CHEMICAL_NAME'].unique()
-metals.sort()
+metals = sorted(data.values('CHEMICAL_NAME'))
 
 msg.info('Select a chemical from the dropdown below.')
 chemical = st.selectbox("Chemicals:", [' '] + ['All'] + list(metals))
 if not chemical or chemical == ' ':
     st.stop()
-msg.info('Calculating statistics..')
-try: 
-    if chemical == 'All':
-        filename =  os.path.join(current_path, "files/output.xlsx")
-        workbook = xlsxwriter.Workbook(filename)
-        for i, metal in enumerate(list(metals)):
-            msg.info(f"Calculating Statistics for {metal} ({i+1}/{len(metals)})")
-            metal_data = df[df['CHEMICAL_NAME'] == metal]
-            metal_name = metal_data['CHEMICAL_NAME'].unique()[0]
-            stats = get_metal_stats(metal_data, metal_name)
-            to_sheet(metal_data, stats, workbook)
+file_name = "stats.xlsx"
+if chemical == 'All':
+    #the workbook for every chemical is built in the background. It keeps running through reruns,
+    #and anyone else asking for the same file gets the same job.
+    output = st.radio("Download as:", list(ALL_OUTPUTS), horizontal=True)
+    split, file_name = ALL_OUTPUTS[output]
+    if split:
+        #separate workbooks are built by their own worker processes, each going into the zip as soon as it is done
+        job = submit(job_registry(), (file_hash, chemical, split), all_zip, data, split)
+    else:
+        job = submit(job_registry(), (file_hash, chemical), all_workbook, data, chart_cache(file_hash))
+    if not job['future'].done():
+        text = "Building the workbooks for every chemical. It keeps going if you change anything on the page."
+        if split:
+            text += " Each workbook can be downloaded below as soon as it is done, the zip once they all are."
+        msg.info(text)
+        job_progress(job)
+        st.stop()
+    try:
+        workbook = job['future'].result()
+    except Exception as e:
+        msg.warning("Error processing data. Please ensure the data is valid")
+        st.error(e)
+        st.stop()
+    records += job['records']
+else:
+    msg.info('Calculating statistics..')
+    metal_data = None
+    try:
+        with collect() as run_records:
+            stats = cached_stats(file_hash, chemical, data)
+            msg.info(f"Rendering charts for {chemical}...")
+            images = workbook_charts(file_hash, chemical, data)
+            msg.info("Writing workbook...")
+            workbook = cached_workbook(file_hash, chemical, data, stats, images)
 
-        workbook.close()
+            #get single data
+            metal_dataset = data.subset(CHEMICAL_NAME=chemical)
+            metal_data = metal_dataset.df
+            st.write('Sample count:', len(metal_data))
 
-    else:
-        #get single data
-        metal_data = df[df['CHEMICAL_NAME'] == chemical]
-        metal_name = metal_data['CHEMICAL_NAME'].unique()[0]
-        stats = get_metal_stats(metal_data, metal_name)
-        to_sheet(metal_data, stats)
-
-        st.write('Sample count:', len(metal_data))
-
-        #lets also show a plot
-        plot_type = st.selectbox("Plot Type:", ['Scatter', 'Line', 'Scatter by Site'])
-        if plot_type == 'Scatter':
-            scatter(metal_data, metal_name, True)
-            st.image(f'files/{metal_name}.png')
-        elif plot_type == 'Line':
-            siteLineChart(metal_data, metal_name)
-            st.image(f'files/{metal_name}_site_line.png')
-        elif plot_type == 'Scatter by Site':
-            siteScatter(metal_data, metal_name)
-            st.image(f'files/{metal_name}_site_scatter.png')
-        #filter colums to only the required cols
-        metal_data = metal_data[required_cols]
+            #lets also show a plot
+            plot_type = st.selectbox("Plot Type:", ['Scatter', 'Line', 'Scatter by Site'])
+            st.image(cached_plot(file_hash, chemical, plot_type, PREVIEW_DPI, metal_dataset))
+            #filter colums to only the required cols
+            metal_data = metal_data[required_cols]
+            st.write(metal_data)
+        records += run_records
+
+    except Exception as e:
+        msg.warning("Error processing data. Please ensure the data is valid")
         st.write(metal_data)
-    
-except Exception as e:
-    msg.warning("Error processing data. Please ensure the data is valid")
-    st.write(metal_data)
-    st.error(e)
-    st.stop()
+        st.error(e)
+        st.stop()
 
 msg.info("Ready for download.")
 
-with open ("files/output.xlsx", "rb") as f:
-    button.download_button("Download", f, "stats.xlsx")
\ No newline at end of file
+button.download_button("Download", workbook, file_name)
+
+if diagnostics:
+    with st.expander("Diagnostics", expanded=True):
+        if records:
+            st.dataframe(pd.DataFrame(records))
+        else:
+            st.write("Everything on this run came from the cache.")
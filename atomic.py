@@ -0,0 +1,17 @@
+import os
+import threading
+from contextlib import contextmanager
+
+#Files that are read back later (the upload cache, saved stats, output zips) are written under a temporary name
+#and moved into place in one step. Nobody ever reads half a file, and a failed write leaves the old file as it was.
+
+@contextmanager
+def atomic_path(path):
+    #yields the temporary path to write to. It replaces path when the block finishes and is removed if the block fails.
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,155 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from dataset import Dataset
+from ingest import read_data
+from instrument import stage, trace_memory
+from stat_functions import build_workbook, get_all_stats, render_charts, sheet_chart_jobs
+
+#Benchmark for the upload-to-workbook path on synthetic lab data.
+#Each stage is timed separately and every run is appended as one json line to the output file,
+#so runs can be compared over time:  python bench.py --samples 200000 --chemicals 20
+#The app's cold start (time until the upload page renders) is measured too, see startup().
+
+#loc types and whether they are split into WASHED/UNWASH samples. SOIL has no subtype split.
+LOC_TYPES = {'SOIL': False, 'LICHEN': True, 'VEG': True}
+
+def make_dataset(chemicals=10, locations=50, years=10, samples=50_000, ref_share=0.2, washed_share=0.5, seed=0):
+    #raw export with the required columns, dates written the way the lab exports them
+    rng = np.random.default_rng(seed)
+    n_ref = int(round(locations * ref_share))
+    loc_ids = np.array([f'REF-{i}' for i in range(n_ref)] + [f'SITE-{i}' for i in range(locations - n_ref)])
+    loc_types = np.array(list(LOC_TYPES))
+    chemical_names = np.array([f'CHEMICAL {i}' for i in range(chemicals)])
+
+    loc_type = loc_types[rng.integers(0, len(loc_types), samples)]
+    split = np.isin(loc_type, [t for t, has_split in LOC_TYPES.items() if has_split])
+    subtype = np.where(rng.random(samples) < washed_share, 'WASHED', 'UNWASH')
+    subtype = np.where(split, subtype, 'NONE')
+    first_year = 2024 - years + 1
+    dates = pd.to_datetime(f'{first_year}-01-01') + pd.to_timedelta(rng.integers(0, 365 * years, samples), unit='D')
+    #lognormal concentrations reported to 0-3 decimals, like real results
+    decimals = rng.integers(0, 4, samples)
+    values = np.round(rng.lognormal(1, 1, samples) * 10.0 ** decimals) / 10.0 ** decimals
+
+    return pd.DataFrame({
+        'LOC_ID': loc_ids[rng.integers(0, locations, samples)],
+        'LOC_TYPE': loc_type,
+        'LOC_SUBTYPE': subtype,
+        'CHEMICAL_NAME': chemical_names[rng.integers(0, chemicals, samples)],
+        'REPORT_RESULT_VALUE': values,
+        'REPORT_RESULT_UNIT': 'mg/kg',
+        'SAMPLE_DATE': dates.strftime('%m/%d/%Y'),
+        'LAB_NOTE': 'synthetic',
+    })
+
+@contextlib.contextmanager
+def bench_stage(records, name):
+    #a top level stage. Chart workers run in other processes, their allocations are not traced.
+    with stage(name) as record:
+        yield record
+    records.append(record)
+
+def run(csv_bytes, workers=None, memory=True):
+    trace_memory(memory)
+    results = []
+    with bench_stage(results, 'ingest') as result:
+        df = read_data(io.BytesIO(csv_bytes), 'bench.csv')
+        result['rows'] = len(df)
+    with bench_stage(results, 'dataset'):
+        dataset = Dataset(df)
+    with bench_stage(results, 'stats'):
+        all_stats = get_all_stats(dataset)
+    chemicals = dataset.groups('CHEMICAL_NAME')
+    with bench_stage(results, 'charts') as result:
+        images = render_charts([job for metal, metal_data in chemicals for job in sheet_chart_jobs(metal_data)], workers)
+        result['images'] = len(images)
+    with bench_stage(results, 'workbook') as result:
+        result['bytes'] = len(build_workbook(dataset, io.BytesIO(), all_stats, images).getvalue())
+    trace_memory(False)
+    return results
+
+#runs in a fresh interpreter: time the app's first script run (the upload page), and list the heavy modules it imported
+STARTUP_SCRIPT = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(sys.argv[1], default_timeout=60)
+start = time.perf_counter()
+app.run()
+seconds = time.perf_counter() - start
+heavy = ['pandas', 'matplotlib', 'scipy', 'xlsxwriter', 'pyarrow']
+print(json.dumps({'seconds': seconds, 'errors': [e.value for e in app.exception], 'modules': [m for m in heavy if m in sys.modules]}))
+'''
+
+def startup(runs=3):
+    #time to first render of the app from a cold interpreter, the median of runs.
+    #Streamlit itself is already imported when the clock starts, everything the app imports is counted.
+    app = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, app], capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    if results[-1]['errors']:
+        raise RuntimeError(f"app failed on startup: {results[-1]['errors']}")
+    return {
+        'stage': 'startup',
+        'seconds': round(float(np.median([r['seconds'] for r in results])), 4),
+        'runs': runs,
+        'modules': results[-1]['modules'],
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ingest, stats, charts and workbook writing on synthetic data.')
+    parser.add_argument('--chemicals', type=int, default=10)
+    parser.add_argument('--locations', type=int, default=50)
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=50_000)
+    parser.add_argument('--ref-share', type=float, default=0.2, help='share of locations that are REF locations')
+    parser.add_argument('--washed-share', type=float, default=0.5, help='share of split samples that are WASHED')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='chart render processes, defaults to the core count')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace allocations, tracing slows every stage down")
+    parser.add_argument('--startup-runs', type=int, default=3, help='cold starts of the app to time, 0 to skip')
+    parser.add_argument('--output', default='bench_results.jsonl', help='json lines file the run is appended to')
+    args = parser.parse_args(argv)
+
+    config = {key: value for key, value in vars(args).items() if key not in ['output', 'no_memory', 'startup_runs']}
+    csv_bytes = make_dataset(args.chemicals, args.locations, args.years, args.samples, args.ref_share, args.washed_share, args.seed).to_csv(index=False).encode()
+    stages = [startup(args.startup_runs)] if args.startup_runs else []
+    stages += run(csv_bytes, args.workers, memory=not args.no_memory)
+
+    record = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'config': config,
+        'stages': stages,
+        'total_seconds': round(sum(s['seconds'] for s in stages), 4),
+    }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    for s in stages:
+        print(f"{s['stage']:<10} {s['seconds']:>9.3f}s" + (f"  peak {s['peak_mb']:.1f} MB" if 'peak_mb' in s else '')
+              + (f"  imports {', '.join(s['modules']) or 'none'}" if 'modules' in s else ''))
+    print(f"{'total':<10} {record['total_seconds']:>9.3f}s  -> {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataset import Dataset
+from export import STATS_FORMATS, stats_table, write_stats
+from ingest import check_columns, read_data, stream_stats
+from stat_functions import SPLITS, build_workbook, build_zip, get_all_stats
+from stats_state import get_state_stats, update_state
+
+#Headless batch mode: one stats workbook per input file, files processed across a worker pool.
+#  python cli.py exports/ "archive/*.xlsx" --output-dir workbooks --workers 4
+#With --stats-only just the numbers are written, as a long table, and no charts are rendered:
+#  python cli.py exports/ --stats-only --format parquet
+#With --split each input becomes a zip of workbooks, one per chemical (or per LOC_TYPE):
+#  python cli.py export.csv --split chemical --workers 4
+#With --state the inputs are added to saved stats (see stats_state.py) and the stats table of everything so far is written:
+#  python cli.py batch_2024.csv --state stats_state.csv --format parquet
+
+INPUT_TYPES = ('.csv', '.xlsx')
+
+def find_inputs(patterns):
+    #files from any mix of directories, globs and plain paths, in a stable order without duplicates
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            matches = sorted(glob.glob(pattern)) or [pattern]
+        for path in matches:
+            if path.lower().endswith(INPUT_TYPES) and path not in paths:
+                paths.append(path)
+    return paths
+
+def output_paths(inputs, output_dir, extension='xlsx'):
+    #<output_dir>/<input name>.<extension>, numbered when two inputs share a name
+    outputs = {}
+    used = set()
+    for path in inputs:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name, i = stem, 1
+        while name in used:
+            i += 1
+            name = f'{stem}_{i}'
+        used.add(name)
+        outputs[path] = os.path.join(output_dir, f'{name}.{extension}')
+    return outputs
+
+def process_file(path, output):
+    #build the workbook for one input. Charts render in this worker only, the pool is already one process per file.
+    with open(path, 'rb') as f:
+        df = read_data(f, path.lower())
+    check_columns(df.columns)
+    build_workbook(df, output, max_workers=1)
+    return output
+
+def process_zip(path, output, split, max_workers=1):
+    #the zip of workbooks for one input, one workbook per split value built across max_workers processes
+    with open(path, 'rb') as f:
+        df = read_data(f, path.lower())
+    check_columns(df.columns)
+    return build_zip(df, output, split, max_workers)
+
+def process_stats(path, output):
+    #the stats table for one input. csv files are streamed in chunks and never held in memory whole.
+    if path.lower().endswith('.csv'):
+        with open(path, 'rb') as f:
+            all_stats = stream_stats(f)
+    else:
+        with open(path, 'rb') as f:
+            df = read_data(f, path.lower())
+        check_columns(df.columns)
+        all_stats = get_all_stats(Dataset(df))
+    return write_stats(stats_table(all_stats), output)
+
+def run(inputs, output_dir, workers=None, stats_format=None, split=None):
+    #returns {input path: error message} for every file that failed.
+    #With a stats_format only the stats table is written, in that format. With a split each input gets a zip of workbooks.
+    os.makedirs(output_dir, exist_ok=True)
+    if stats_format:
+        outputs = output_paths(inputs, output_dir, stats_format)
+        process, options = process_stats, ()
+    elif split:
+        #a single input gets all the workers for its workbooks, otherwise the pool is already one process per input
+        outputs = output_paths(inputs, output_dir, 'zip')
+        process, options = process_zip, (split, workers if len(inputs) == 1 else 1)
+    else:
+        outputs = output_paths(inputs, output_dir)
+        process, options = process_file, ()
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {pool.submit(process, path, output, *options): path for path, output in outputs.items()}
+        for job in as_completed(jobs):
+            path = jobs[job]
+            try:
+                print(f'ok      {path} -> {job.result()}', flush=True)
+            except Exception as e:
+                failures[path] = f'{type(e).__name__}: {e}'
+                print(f'failed  {path}: {failures[path]}', file=sys.stderr, flush=True)
+    return failures
+
+def run_state(inputs, state_path, output):
+    #fold each input into the state in turn, then write the stats table of the whole state to output.
+    #Returns {input path: error message} like run. A file already in the state is reported and not counted again.
+    failures = {}
+    for path in inputs:
+        try:
+            with open(path, 'rb') as f:
+                df = read_data(f, path.lower())
+            check_columns(df.columns)
+            update_state(state_path, df, os.path.basename(path))
+            print(f'ok      {path} -> {state_path}', flush=True)
+        except Exception as e:
+            failures[path] = f'{type(e).__name__}: {e}'
+            print(f'failed  {path}: {failures[path]}', file=sys.stderr, flush=True)
+    write_stats(stats_table(get_state_stats(state_path)), output)
+    print(f'stats   {state_path} -> {output}', flush=True)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a stats workbook (or just the stats table) for every csv/xlsx export given.')
+    parser.add_argument('inputs', nargs='+', help='files, directories or glob patterns')
+    parser.add_argument('--output-dir', default='output', help='where the workbooks are written (default: output)')
+    parser.add_argument('--workers', type=int, default=None, help='files processed at once, defaults to the core count')
+    parser.add_argument('--stats-only', action='store_true', help='write only the stats as a long table, without charts or workbook')
+    parser.add_argument('--format', choices=STATS_FORMATS, default='csv', help='file type of the --stats-only table (default: csv)')
+    parser.add_argument('--split', choices=list(SPLITS), default=None, help='write a zip with one workbook per chemical or per loc_type instead of one workbook')
+    parser.add_argument('--state', default=None, help='add the inputs to the saved stats in this file (created if missing) and write the stats table of all of it')
+    args = parser.parse_args(argv)
+    if args.stats_only and args.split:
+        parser.error('--split builds workbooks, it can not be combined with --stats-only')
+    if args.state and args.split:
+        parser.error('--state writes the stats table, it can not be combined with --split')
+
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        parser.error('no csv or xlsx files found')
+    if args.state:
+        os.makedirs(args.output_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(args.state))[0]
+        failures = run_state(inputs, args.state, os.path.join(args.output_dir, f'{name}.{args.format}'))
+    else:
+        failures = run(inputs, args.output_dir, args.workers, args.format if args.stats_only else None, args.split)
+    print(f'{len(inputs) - len(failures)} of {len(inputs)} files processed')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
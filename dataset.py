@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+from instrument import stage
+
+#An upload sorted once by the dimensions every report is split on, so any split is a range of rows.
+#Rows are ordered by KEYS (chemicals in the same order groupby(sort=True) gives), which makes every
+#chemical, every (chemical, LOC_TYPE), every (chemical, LOC_TYPE, subtype) etc. one contiguous block.
+#`ranges` has one row per distinct key with the [start, stop) row positions of its block. Stats, charts and
+#sheets take their rows as slices of the sorted frame instead of comparing strings row by row again.
+
+KEYS = ['CHEMICAL_NAME', 'LOC_TYPE', 'LOC_SUBTYPE', 'IS_REF', 'SAMPLE_YEAR']
+
+def is_ref(loc_ids):
+    #locations with 'REF' in the name are reference locations, everything else is site
+    if isinstance(loc_ids.dtype, pd.CategoricalDtype):
+        #check each category once instead of every row
+        ref_categories = loc_ids.cat.categories.astype(str).str.contains('REF', regex=False)
+        codes = loc_ids.cat.codes.to_numpy()
+        return pd.Series(np.where(codes >= 0, ref_categories[codes], False), index=loc_ids.index, name='IS_REF')
+    return loc_ids.astype(str).str.contains('REF', regex=False).rename('IS_REF')
+
+def key_codes(values):
+    #integer codes sorting like groupby(sort=True): category order for categoricals, sorted values otherwise.
+    #Missing values get the highest code so they sort last.
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy().astype(np.int64)
+    else:
+        codes = pd.factorize(values, sort=True)[0].astype(np.int64)
+    return np.where(codes < 0, codes.max(initial=0) + 1, codes)
+
+class Dataset:
+    def __init__(self, df, ranges=None):
+        #df is a frame as read by ingest.read_data. ranges is only passed by subset(), for rows already sorted.
+        if ranges is None:
+            with stage('dataset', rows=len(df)):
+                df, ranges = sort_rows(df)
+        self.df = df
+        self.ranges = ranges
+
+    def __len__(self):
+        return len(self.df)
+
+    def positions(self, **keys):
+        #[start, stop) ranges of the blocks matching keys, e.g. positions(LOC_TYPE='SOIL', IS_REF=True).
+        #A key can also be given a list of values.
+        ranges = self.ranges
+        for key, value in keys.items():
+            if isinstance(value, (list, tuple, set, np.ndarray, pd.Index)):
+                ranges = ranges[ranges[key].isin(list(value))]
+            else:
+                ranges = ranges[ranges[key] == value]
+        return ranges['start'].to_numpy(), ranges['stop'].to_numpy()
+
+    def rows(self, columns=None, **keys):
+        #rows matching keys. A single block of rows is a slice of the sorted frame, not a copy.
+        #Keys that skip a level (e.g. IS_REF without LOC_SUBTYPE) match several blocks, which are gathered.
+        starts, stops = self.positions(**keys)
+        if len(starts) == 0:
+            df = self.df.iloc[0:0]
+        elif (starts[1:] == stops[:-1]).all():
+            df = self.df.iloc[starts[0]:stops[-1]]
+        else:
+            df = self.df.iloc[np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])]
+        return df if columns is None else df[columns]
+
+    def subset(self, columns=None, **keys):
+        #a Dataset of the rows matching keys. Only the key columns plus columns are kept when columns are given.
+        if columns is not None:
+            columns = KEYS + [col for col in columns if col not in KEYS]
+        starts, stops = self.positions(**keys)
+        df = self.rows(columns, **keys)
+        #positions of the kept blocks in the new frame
+        lengths = stops - starts
+        ranges = self.ranges.loc[self.ranges['start'].isin(starts)].copy()
+        ranges['stop'] = np.cumsum(lengths)
+        ranges['start'] = ranges['stop'] - lengths
+        return Dataset(df, ranges.reset_index(drop=True))
+
+    def values(self, key):
+        #distinct values of a key column in row order, without missing values
+        return list(self.ranges[key].dropna().unique())
+
+    def groups(self, key):
+        #(value, Dataset) for each value of key, like groupby(key, sort=True) but without copying the rows
+        return [(value, self.subset(**{key: value})) for value in self.values(key)]
+
+    def cells(self):
+        #stat_functions.cell_stats(df, ['CHEMICAL_NAME', 'LOC_TYPE']) straight from the blocks: each block is one cell,
+        #so the sums are reduceat over the sorted value column, with no grouping of keys.
+        keys = ['CHEMICAL_NAME', 'LOC_TYPE', 'SAMPLE_YEAR', 'LOC_SUBTYPE', 'IS_REF']
+        starts = self.ranges['start'].to_numpy()
+        size = self.ranges['stop'].to_numpy() - starts
+        count = sums = m2 = np.zeros(0)
+        if len(starts):
+            values = self.df['REPORT_RESULT_VALUE'].to_numpy(dtype=float)
+            valid = ~np.isnan(values)
+            count = np.add.reduceat(valid.astype(np.int64), starts)
+            sums = np.add.reduceat(np.where(valid, values, 0), starts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = np.repeat(sums / count, size)
+            m2 = np.add.reduceat(np.where(valid, values - means, 0) ** 2, starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.where(count > 1, m2 / (count - 1), np.nan)
+        #blocks with a missing key are cells too, as in cell_stats
+        return pd.DataFrame({'size': size, 'count': count.astype(np.int64), 'sum': sums, 'var': var, 'm2': np.where(count > 1, m2, 0.0)},
+                            index=pd.MultiIndex.from_frame(self.ranges[keys]))
+
+def as_dataset(data):
+    #a Dataset as it is, a frame as read by ingest.read_data sorted into one
+    return data if isinstance(data, Dataset) else Dataset(data)
+
+def sort_rows(df):
+    #df sorted by KEYS (stable, so rows keep their file order inside a block) and the blocks' ranges
+    df = df.assign(IS_REF=is_ref(df['LOC_ID']))
+    codes = [key_codes(df[key]) for key in KEYS]
+    order = np.lexsort(codes[::-1])
+    df = df.iloc[order].reset_index(drop=True)
+    codes = np.column_stack([c[order] for c in codes]) if len(df) else np.zeros((0, len(KEYS)), np.int64)
+    starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]).any(axis=1)]) if len(df) else np.zeros(0, int)
+    stops = np.r_[starts[1:], len(df)].astype(int)
+    ranges = df[KEYS].iloc[starts].reset_index(drop=True)
+    ranges['start'] = starts
+    ranges['stop'] = stops
+    return df, ranges
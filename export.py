@@ -0,0 +1,44 @@
+import os
+import json
+import pandas as pd
+from stat_functions import SUBSETS
+
+#The stats without the workbook: get_all_stats flattened to one row per
+#(chemical, loc_type, year, subtype, ref/site), for loading into other systems.
+#t, p and significant are the site vs ref test of the row's year and subtype, so they repeat on its ref and site rows.
+
+STATS_COLUMNS = ['chemical', 'loc_type', 'year', 'subtype', 'location', 'count', 'mean', 'std', 't', 'p', 'significant']
+#file types write_stats can write, by extension
+STATS_FORMATS = ['csv', 'json', 'parquet']
+
+def stats_table(all_stats):
+    rows = []
+    for chemical, chemical_stats in all_stats.items():
+        for loc_type, stats in chemical_stats.items():
+            for year, year_stats in stats['historic'].items():
+                for subset, (subtype, ref) in SUBSETS.items():
+                    ttest = year_stats[subset.split('_')[0] + '_ttest']
+                    rows.append([chemical, loc_type, year, subtype, 'ref' if ref else 'site',
+                                 year_stats[subset]['count'], year_stats[subset]['mean'], year_stats[subset]['std'],
+                                 ttest['t'], ttest['p'], None if ttest['p'] is None else bool(ttest['significant'])])
+    table = pd.DataFrame(rows, columns=STATS_COLUMNS)
+    #missing values stay missing in every format: floats as NaN/null, significant as a nullable boolean
+    return table.astype({'chemical': str, 'loc_type': str, 'year': 'int64', 'count': 'int64',
+                         'mean': float, 'std': float, 't': float, 'p': float, 'significant': 'boolean'})
+
+def write_stats(table, path):
+    #write the table in the format given by the file extension
+    file_type = os.path.splitext(path)[1].lower().lstrip('.')
+    if file_type == 'csv':
+        table.to_csv(path, index=False)
+    elif file_type == 'json':
+        #written by the json module so every number keeps all its digits. pandas' to_json rounds to a number of
+        #decimal places (10 by default, 15 at most), which changes the numbers and turns tiny p-values into 0.
+        records = table.astype(object).where(table.notna(), None).to_dict('records')
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=1)
+    elif file_type == 'parquet':
+        table.to_parquet(path, index=False)
+    else:
+        raise ValueError(f"Can't write stats as {file_type or path}, use one of: " + ", ".join(STATS_FORMATS))
+    return path
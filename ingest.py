@@ -0,0 +1,141 @@
+import os
+import hashlib
+from io import BytesIO
+import pandas as pd
+from pandas.api.types import union_categoricals
+from stat_functions import cell_stats, combine_cells, all_stats_from_cells
+from instrument import stage
+from atomic import atomic_path
+
+#columns the app needs. Anything else in an export is dropped while reading.
+REQUIRED_COLS = ['LOC_ID', 'LOC_TYPE', 'LOC_SUBTYPE', 'CHEMICAL_NAME', 'REPORT_RESULT_VALUE', 'REPORT_RESULT_UNIT', 'SAMPLE_DATE']
+#low cardinality text columns, stored as categories instead of one python string per row
+CATEGORY_COLS = ['LOC_ID', 'LOC_TYPE', 'LOC_SUBTYPE', 'CHEMICAL_NAME', 'REPORT_RESULT_UNIT']
+#date format of our lab exports. Other formats still parse, just slower.
+DATE_FORMAT = '%m/%d/%Y'
+#rows per chunk when streaming a csv
+CHUNKSIZE = 500_000
+
+#parsed uploads are kept here as feather files named by the hash of the upload
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+#how many cached uploads to keep. The least recently used are deleted first.
+CACHE_FILES = 20
+#part of the cache file names, changed whenever the cached frames would come out differently.
+#Files of older versions are never read again and pruned like any other.
+CACHE_VERSION = 2
+
+#REPORT_RESULT_VALUE stays float64. float32 would change the reported decimals and means.
+
+class MissingColumns(ValueError):
+    pass
+
+def missing_columns(columns):
+    return [col for col in REQUIRED_COLS if col not in columns]
+
+def check_columns(columns):
+    missing = missing_columns(columns)
+    if missing:
+        raise MissingColumns("Missing required columns: " + ", ".join(missing))
+
+def read_data(file, file_name, chunksize=CHUNKSIZE):
+    #read an upload into a typed frame with only the required columns plus SAMPLE_YEAR.
+    #csv files are read in chunks so peak memory is the slim frame plus one raw chunk. The frame itself still
+    #grows with the file: charts and sheets need every row. Only stream_stats is bounded by the chunk size.
+    with stage('read_data', file=os.path.basename(file_name)) as record:
+        if file_name.endswith(".csv"):
+            df = concat_chunks([prepare(chunk) for chunk in read_csv_chunks(file, chunksize)])
+        else:
+            df = prepare(pd.read_excel(file, usecols=lambda col: col in REQUIRED_COLS))
+        record['rows'] = len(df)
+    return df
+
+def read_upload(data, file_name, file_hash=None, cache_dir=CACHE_DIR):
+    #read_data for raw upload bytes, through a columnar cache. The first successful parse of a file with all
+    #required columns is saved as feather, later loads of the same bytes memory-map that copy instead of
+    #parsing the csv/workbook again. Without pyarrow this is just read_data.
+    file_hash = file_hash or hashlib.sha256(data).hexdigest()
+    path = os.path.join(cache_dir, f'{file_hash}.v{CACHE_VERSION}.feather')
+    if os.path.exists(path):
+        try:
+            with stage('read_cache', file=os.path.basename(file_name)) as record:
+                df = read_feather(path)
+                record['rows'] = len(df)
+            os.utime(path)
+            return df
+        except Exception:
+            #unreadable cache file (older pyarrow, partial copy). Parse the upload again and replace it.
+            pass
+    df = read_data(BytesIO(data), file_name)
+    if not missing_columns(df.columns):
+        try:
+            write_feather(df, path)
+            prune_cache(cache_dir)
+        except (ImportError, OSError):
+            pass
+    return df
+
+def read_feather(path):
+    from pyarrow import feather
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+def write_feather(df, path):
+    #through a temporary name so a concurrent reader never sees half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_path(path) as tmp_path:
+        df.reset_index(drop=True).to_feather(tmp_path)
+
+def prune_cache(cache_dir, keep=CACHE_FILES):
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.feather')]
+    for path in sorted(paths, key=os.path.getmtime)[:-keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def read_csv_chunks(file, chunksize=CHUNKSIZE):
+    return pd.read_csv(file, usecols=lambda col: col in REQUIRED_COLS, dtype={col: 'category' for col in CATEGORY_COLS}, chunksize=chunksize)
+
+def stream_stats(file, chunksize=CHUNKSIZE):
+    #get_all_stats for a csv of any size. Each chunk is reduced to its stat cells and folded into the
+    #running total, so only one chunk is ever held in memory. Used where no workbook is built (cli.py --stats-only),
+    #the app reads the whole upload with read_data since its charts and sheets need the rows.
+    cells = None
+    for chunk in read_csv_chunks(file, chunksize):
+        check_columns(chunk.columns)
+        chunk_cells = cell_stats(prepare(chunk), ['CHEMICAL_NAME', 'LOC_TYPE'])
+        cells = chunk_cells if cells is None else combine_cells(cells, chunk_cells)
+    if cells is None:
+        return {}
+    return all_stats_from_cells(cells)
+
+def prepare(df):
+    #types for a raw frame. Missing columns are left for the caller to report.
+    for col in CATEGORY_COLS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    if 'SAMPLE_DATE' in df.columns:
+        df['SAMPLE_DATE'] = parse_dates(df['SAMPLE_DATE'])
+        df['SAMPLE_YEAR'] = df['SAMPLE_DATE'].dt.year
+    return df
+
+def parse_dates(dates, date_format=DATE_FORMAT):
+    #an explicit format is much faster than letting pandas infer one per value
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    try:
+        return pd.to_datetime(dates, format=date_format)
+    except (ValueError, TypeError):
+        return pd.to_datetime(dates)
+
+def concat_chunks(chunks):
+    #concat keeping categorical columns categorical. pd.concat falls back to object when the chunks' categories differ.
+    if not chunks:
+        return pd.DataFrame(columns=REQUIRED_COLS)
+    columns = {}
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            #sorted like the categories of a single chunk, so the order of chemicals doesn't depend on the file size
+            columns[col] = union_categoricals([chunk[col] for chunk in chunks], sort_categories=True)
+        else:
+            columns[col] = pd.concat([chunk[col] for chunk in chunks], ignore_index=True)
+    return pd.DataFrame(columns)
@@ -0,0 +1,100 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+#Lightweight stage timing. Every stage records wall time, row count and tags (chemical, LOC_TYPE, chart name),
+#is emitted as one json log line on the 'stats' logger, and is added to any open collect() block.
+#Peak allocations are only recorded while memory tracing is on, tracing slows python code down considerably.
+
+logger = logging.getLogger('stats')
+
+#records of the innermost open collect() block, and the stages currently running
+_collector = contextvars.ContextVar('collector', default=None)
+_open_stages = contextvars.ContextVar('open_stages', default=())
+
+def configure_logging(stream=sys.stderr, level=logging.INFO):
+    #send stage records to stream, one json object per line
+    if not logger.handlers:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+def trace_memory(enabled=True):
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+if os.environ.get('STATS_TRACE_MEMORY') == '1':
+    trace_memory()
+
+@contextlib.contextmanager
+def collect():
+    #gather the records of every stage run inside the block
+    records = []
+    token = _collector.set(records)
+    try:
+        yield records
+    finally:
+        _collector.reset(token)
+
+@contextlib.contextmanager
+def stage(stage_name, **tags):
+    #time the block. The yielded record can take extra fields, e.g. record['rows'] once they are known.
+    record = {'stage': stage_name, **tags}
+    tracing = tracemalloc.is_tracing()
+    parents = _open_stages.get()
+    if tracing:
+        #keep the peak reached so far by the enclosing stage before resetting it for this one
+        if parents:
+            parents[-1]['_peak'] = max(parents[-1]['_peak'], tracemalloc.get_traced_memory()[1])
+        record['_start'] = tracemalloc.get_traced_memory()[0]
+        record['_peak'] = record['_start']
+        tracemalloc.reset_peak()
+    token = _open_stages.set(parents + (record,))
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 4)
+        _open_stages.reset(token)
+        if tracing and tracemalloc.is_tracing():
+            peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = round((peak - record.pop('_start')) / 2**20, 2)
+            if parents:
+                parents[-1]['_peak'] = max(parents[-1]['_peak'], peak)
+        else:
+            record.pop('_peak', None)
+            record.pop('_start', None)
+        emit(record)
+
+def emit(record):
+    #log a finished record and add it to the open collect() block. Also used for records from worker processes.
+    records = _collector.get()
+    if records is not None:
+        records.append(record)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(record, default=str))
+
+def timed(stage_name):
+    #stage() as a decorator. Records the length of the first argument as rows,
+    #and the second argument as chart when it is a string (the chart functions' name, '<chemical>_<LOC_TYPE>').
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tags = {}
+            if len(args) > 1 and isinstance(args[1], str):
+                tags['chart'] = args[1]
+            if args and hasattr(args[0], '__len__'):
+                tags['rows'] = len(args[0])
+            with stage(stage_name, **tags):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import collect
+
+#Background jobs for work too long to run inside a streamlit script run (e.g. the workbook for every chemical).
+#Jobs live in a registry shared by all sessions and are keyed by what they compute, e.g. (upload hash, chemical):
+#a rerun or another user asking for the same thing gets the job that is already running instead of a new one.
+#A job is a dict the app reads on each rerun:
+#  step, done, total, chemical   progress as reported by the job function
+#  records                      stage records of the job, for the diagnostics panel
+#  files                        (file name, bytes) of each file the job has finished so far, for jobs that make several
+#  future                       result() is the job function's return value, or raises its error
+
+def new_registry(max_workers=2, max_finished=8):
+    #max_finished finished jobs (and their results) are kept, the oldest are dropped first
+    return {
+        'executor': ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stats-job'),
+        'jobs': {},
+        'lock': threading.Lock(),
+        'max_finished': max_finished,
+    }
+
+def submit(registry, key, func, *args, **kwargs):
+    #the job for key, starting func(*args, progress=..., add_file=..., **kwargs) in the background unless there already is one.
+    #func reports progress as progress(step, done, total, chemical=None) and hands over each finished file as add_file(name, contents).
+    #A job that failed is started again, so an error (e.g. a broken worker pool) can be retried.
+    with registry['lock']:
+        job = registry['jobs'].get(key)
+        if job is None or failed(job):
+            job = {'step': 'queued', 'done': 0, 'total': 0, 'chemical': None, 'records': [], 'files': []}
+            def progress(step, done, total, chemical=None):
+                job.update(step=step, done=done, total=total, chemical=chemical)
+            def add_file(name, contents):
+                job['files'].append((name, contents))
+            job['future'] = registry['executor'].submit(run_job, job, func, *args, progress=progress, add_file=add_file, **kwargs)
+            registry['jobs'][key] = job
+            prune(registry)
+        return job
+
+def failed(job):
+    future = job['future']
+    return future.done() and (future.cancelled() or future.exception() is not None)
+
+def run_job(job, func, *args, **kwargs):
+    with collect() as records:
+        job['records'] = records
+        return func(*args, **kwargs)
+
+def prune(registry):
+    #drop the oldest finished jobs over the limit. Running jobs are never dropped.
+    finished = [key for key, job in registry['jobs'].items() if job['future'].done()]
+    for key in finished[:max(len(finished) - registry['max_finished'], 0)]:
+        del registry['jobs'][key]
@@ -1,153 +1,447 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
-from scipy.stats import ttest_ind
-import xlsxwriter
-import os, sys
-
-
-def get_metal_stats(df, metal):
-    stats = {}
+import os
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+from weakref import WeakKeyDictionary
+from instrument import collect, emit, stage, timed
+from atomic import atomic_path
+from dataset import Dataset, as_dataset, is_ref
+from trends import mann_kendall
+
+#matplotlib, scipy and xlsxwriter take seconds to import, so they are imported by the functions that use them.
+#The app only pays for them once there is data to chart or a workbook to write.
+
+__all__ = [
+    'get_all_stats', 'all_stats_from_cells', 'get_metal_stats', 'get_stats', 'cell_stats', 'combine_cells', 'stats_from_cells',
+    'scatter', 'siteScatter', 'siteLineChart', 'EXPORT_DPI', 'PREVIEW_DPI', 'chart_name', 'sheet_chart_jobs', 'render_charts',
+    'build_workbook', 'build_zip', 'SPLITS', 'to_sheet', 'CHART_COLS',
+]
+
+
+def get_all_stats(data):
+    #stats for every chemical and loc_type from one pass over a Dataset or frame. Keyed by chemical, then loc_type.
+    if isinstance(data, Dataset):
+        return all_stats_from_cells(data.cells())
+    return all_stats_from_cells(cell_stats(data, ['CHEMICAL_NAME', 'LOC_TYPE']))
+
+def all_stats_from_cells(cells):
+    #cells indexed by (CHEMICAL_NAME, LOC_TYPE, SAMPLE_YEAR, LOC_SUBTYPE, IS_REF) to the get_all_stats dict.
+    #Rows without a chemical or LOC_TYPE are in no stats, the same as selecting a chemical's loc_types by name.
+    all_stats = {}
+    for (metal, loc_type), loc_type_cells in cells.groupby(level=['CHEMICAL_NAME', 'LOC_TYPE'], observed=True, sort=False):
+        with stage('stats', chemical=metal, loc_type=loc_type, rows=int(loc_type_cells['size'].sum())):
+            all_stats.setdefault(metal, {})[loc_type] = stats_from_cells(loc_type_cells.droplevel(['CHEMICAL_NAME', 'LOC_TYPE']))
+
+    return all_stats
+
+def get_metal_stats(data, metal):
     #grab data for given metal.
-    metal_data = df[df['CHEMICAL_NAME'] == metal]
-    #split into each unique loc_type
-    loc_types = metal_data['LOC_TYPE'].unique()
-    for loc_type in loc_types:
-        #get data for each loc_type
-        loc_type_data = metal_data[metal_data['LOC_TYPE'] == loc_type]
-        print('')
-        print(metal, loc_type, len(loc_type_data))
-
-        stats[loc_type] = get_stats(loc_type_data)
-    
-    return stats
+    if isinstance(data, Dataset):
+        return get_all_stats(data.subset(CHEMICAL_NAME=metal)).get(metal, {})
+    metal_data = data[data['CHEMICAL_NAME'] == metal]
+    return get_all_stats(metal_data).get(metal, {})
 
+@timed('get_stats')
 def get_stats(metal_data):
+    return stats_from_cells(cell_stats(metal_data))
+
+#(LOC_SUBTYPE, is ref) for each subset reported in the stats dict
+SUBSETS = {
+    'washed_ref': ('WASHED', True),
+    'unwashed_ref': ('UNWASH', True),
+    'washed_site': ('WASHED', False),
+    'unwashed_site': ('UNWASH', False),
+}
+
+@timed('cell_stats')
+def cell_stats(df, by=()):
+    #size, count, sum and variance of REPORT_RESULT_VALUE for every (by.., year, subtype, ref/site) cell in one groupby pass.
+    #size includes rows with a missing value, count does not. m2 is the sum of squared deviations from the cell mean.
+    #Missing keys get cells of their own: a LOC_TYPE with no subtypes still has its years, a row with no year still counts all time.
+    keys = [df[col] for col in by] + [df['SAMPLE_YEAR'], df['LOC_SUBTYPE'], is_ref(df['LOC_ID'])]
+    cells = df['REPORT_RESULT_VALUE'].groupby(keys, observed=True, sort=False, dropna=False).agg(['size', 'count', 'sum', 'var'])
+    cells['m2'] = (cells['var'] * (cells['count'] - 1)).fillna(0)
+    return cells
+
+def combine_cells(*cell_tables):
+    #merge cell_stats tables computed on separate pieces of a dataset (chunks of a file, yearly uploads)
+    #into the cells of the whole, using the pairwise update for the sum of squared deviations.
+    cells = pd.concat(cell_tables)
+    levels = list(range(cells.index.nlevels))
+    totals = cells[['size', 'count', 'sum']].groupby(level=levels, observed=True, sort=False, dropna=False).sum()
+    total_mean = (totals['sum'] / totals['count'].replace(0, np.nan)).reindex(cells.index).to_numpy()
+    mean = cells['sum'] / cells['count'].replace(0, np.nan)
+    deviations = (cells['count'] * (mean - total_mean) ** 2).fillna(0)
+    totals['m2'] = (cells['m2'] + deviations).groupby(level=levels, observed=True, sort=False, dropna=False).sum()
+    totals['var'] = totals['m2'] / (totals['count'] - 1).where(totals['count'] > 1)
+    return totals[['size', 'count', 'sum', 'var', 'm2']]
+
+def stats_from_cells(cells):
+    #build the stats dict for one loc_type from its cells, indexed by (SAMPLE_YEAR, LOC_SUBTYPE, IS_REF)
+    from scipy.stats import ttest_ind_from_stats
     stats = {'historic':{}, 'latest':{}}
-    #split metal data between locations with 'REF' in the name and locations without 'REF' in the name
-    metal_ref_data = metal_data[metal_data['LOC_ID'].str.contains('REF')]
-    metal_site_data = metal_data[~metal_data['LOC_ID'].str.contains('REF')]
-    #split into washed and unwashed data
-    metal_ref_washed_data = metal_ref_data[metal_ref_data['LOC_SUBTYPE'] == 'WASHED']
-    metal_ref_unwashed_data = metal_ref_data[metal_ref_data['LOC_SUBTYPE'] == 'UNWASH']
-    metal_site_washed_data = metal_site_data[metal_site_data['LOC_SUBTYPE'] == 'WASHED']
-    metal_site_unwashed_data = metal_site_data[metal_site_data['LOC_SUBTYPE'] == 'UNWASH']
-    
-    # stats['summary'] = {'ref': {'count':len(metal_ref_data.index), 'mean': metal_ref_data['REPORT_RESULT_VALUE'].mean(), 'std': metal_ref_data['REPORT_RESULT_VALUE'].std()}, 'site': {'count': len(metal_data.index), 'mean': metal_data['REPORT_RESULT_VALUE'].mean(), 'std': metal_data['REPORT_RESULT_VALUE'].std()}}
-    #get the correlation over time
+    years = sorted(cells.index.get_level_values('SAMPLE_YEAR').dropna().unique())
+
+    #one row per year for each subset, years without samples are zero
+    subsets = {}
+    totals = {}
+    for subset, (subtype, ref) in SUBSETS.items():
+        subset_cells = cells[(cells.index.get_level_values('LOC_SUBTYPE') == subtype) & (cells.index.get_level_values('IS_REF') == ref)]
+        subset_cells = subset_cells.droplevel(['LOC_SUBTYPE', 'IS_REF'])
+        #rows without a year are in the all time mean, but in no year
+        totals[subset] = subset_cells[['count', 'sum']].sum()
+        subset_cells = subset_cells.reindex(years)
+        subset_cells[['size', 'count', 'sum', 'm2']] = subset_cells[['size', 'count', 'sum', 'm2']].fillna(0)
+        subset_cells['mean'] = subset_cells['sum'] / subset_cells['count'].replace(0, np.nan)
+        subsets[subset] = subset_cells
+
+    #get the correlation over time and the mean value, combining the yearly cells
     stats['all_time'] = {'correlation':{}, 'mean':{}}
-    stats['all_time']['correlation']['unwashed_ref'] = metal_ref_unwashed_data['REPORT_RESULT_VALUE'].corr(metal_ref_unwashed_data['SAMPLE_YEAR'])
-    stats['all_time']['correlation']['unwashed_site'] = metal_site_unwashed_data['REPORT_RESULT_VALUE'].corr(metal_site_unwashed_data['SAMPLE_YEAR'])
-    stats['all_time']['correlation']['washed_ref'] = metal_ref_washed_data['REPORT_RESULT_VALUE'].corr(metal_ref_washed_data['SAMPLE_YEAR'])
-    stats['all_time']['correlation']['washed_site'] = metal_site_washed_data['REPORT_RESULT_VALUE'].corr(metal_site_washed_data['SAMPLE_YEAR'])
-
-    #get the mean value
-    stats['all_time']['mean']['unwashed_ref'] = metal_ref_unwashed_data['REPORT_RESULT_VALUE'].mean()
-    stats['all_time']['mean']['unwashed_site'] = metal_site_unwashed_data['REPORT_RESULT_VALUE'].mean()
-    stats['all_time']['mean']['washed_ref'] = metal_ref_washed_data['REPORT_RESULT_VALUE'].mean()
-    stats['all_time']['mean']['washed_site'] = metal_site_washed_data['REPORT_RESULT_VALUE'].mean()
+    for subset, subset_cells in subsets.items():
+        stats['all_time']['correlation'][subset] = year_correlation(subset_cells)
+        count = totals[subset]['count']
+        stats['all_time']['mean'][subset] = totals[subset]['sum'] / count if count else np.nan
+
+    #get t-test of site vs ref for washed and unwashed, all years at once
+    ttests = {}
+    for subtype in ['washed', 'unwashed']:
+        ref, site = subsets[f'{subtype}_ref'], subsets[f'{subtype}_site']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t, p = ttest_ind_from_stats(ref['mean'].to_numpy(), ttest_std(ref), ref['count'].to_numpy(), site['mean'].to_numpy(), ttest_std(site), site['count'].to_numpy())
+        #a missing value on either side makes ttest_ind give no result, whatever the other values are
+        missing = (ref['size'] != ref['count']).to_numpy() | (site['size'] != site['count']).to_numpy()
+        ttests[f'{subtype}_ttest'] = (np.where(missing, np.nan, t), np.where(missing, np.nan, p))
 
-    
     #get stats for each year
-    years = metal_data['SAMPLE_YEAR'].unique()
-    for year in years:
+    for i, year in enumerate(years):
         year_stats = {}
-        year_data_ref = metal_ref_data[metal_ref_data['SAMPLE_YEAR'] == year]
-        year_data_site = metal_site_data[metal_site_data['SAMPLE_YEAR'] == year]
-        #split into washed and unwashed data
-        year_data_ref_washed = year_data_ref[year_data_ref['LOC_SUBTYPE'] == 'WASHED']
-        year_data_ref_unwashed = year_data_ref[year_data_ref['LOC_SUBTYPE'] == 'UNWASH']
-        year_data_site_washed = year_data_site[year_data_site['LOC_SUBTYPE'] == 'WASHED']
-        year_data_site_unwashed = year_data_site[year_data_site['LOC_SUBTYPE'] == 'UNWASH']
-
         #Get mean, std, count of each subset
-        year_stats['washed_ref'] = {'count': len(year_data_ref_washed.index), 'mean': year_data_ref_washed['REPORT_RESULT_VALUE'].mean(), 'std': year_data_ref_washed['REPORT_RESULT_VALUE'].std()}
-        year_stats['unwashed_ref'] = {'count': len(year_data_ref_unwashed.index), 'mean': year_data_ref_unwashed['REPORT_RESULT_VALUE'].mean(), 'std': year_data_ref_unwashed['REPORT_RESULT_VALUE'].std()}
-        year_stats['washed_site'] = {'count': len(year_data_site_washed.index), 'mean': year_data_site_washed['REPORT_RESULT_VALUE'].mean(), 'std': year_data_site_washed['REPORT_RESULT_VALUE'].std()}
-        year_stats['unwashed_site'] = {'count': len(year_data_site_unwashed.index), 'mean': year_data_site_unwashed['REPORT_RESULT_VALUE'].mean(), 'std': year_data_site_unwashed['REPORT_RESULT_VALUE'].std()}
-
-        #get t-test of site vs ref for washed and unwashed
-        t, p = ttest_ind(year_data_ref_washed['REPORT_RESULT_VALUE'], year_data_site_washed['REPORT_RESULT_VALUE'])
-        year_stats['washed_ttest'] = {'t': t, 'p': p}
-        t, p = ttest_ind(year_data_ref_unwashed['REPORT_RESULT_VALUE'], year_data_site_unwashed['REPORT_RESULT_VALUE']) 
-        year_stats['unwashed_ttest'] = {'t': t, 'p': p}
-        # print(year_stats)
-        #is it significant?
-        year_stats['washed_ttest']['significant'] = year_stats['washed_ttest']['p'] < 0.05
-        year_stats['unwashed_ttest']['significant'] = year_stats['unwashed_ttest']['p'] < 0.05
-
-        stats['historic'][year] = year_stats
+        for subset, subset_cells in subsets.items():
+            cell = subset_cells.loc[year]
+            year_stats[subset] = {'count': int(cell['size']), 'mean': cell['mean'], 'std': np.sqrt(cell['var'])}
+        for name, (t, p) in ttests.items():
+            #is it significant?
+            year_stats[name] = {'t': t[i], 'p': p[i], 'significant': p[i] < 0.05}
+
+        stats['historic'][int(year)] = year_stats
 
         #check if this is the most recent year
-        if year == max(years):
+        if year == years[-1]:
             stats['latest'] = year_stats
-            stats['latest']['year'] = year
-
-    #recursively through all nodes of stats dict and replace nan with None
-    def replace_nan_with_none(d):
-        for k, v in d.items():
-            if isinstance(v, dict):
-                replace_nan_with_none(v)
-            elif isinstance(v, float) and np.isnan(v):
-                d[k] = None
-        return d
+            stats['latest']['year'] = int(year)
 
     return replace_nan_with_none(stats)
 
-def scatter(metal_data, name=None, single=False):
+def year_correlation(subset_cells):
+    #pearson correlation of value with SAMPLE_YEAR from yearly cells. The year is constant inside a cell,
+    #so only the between-year deviations contribute to the co-moment.
+    count = subset_cells['count'].to_numpy()
+    n = count.sum()
+    if n < 2:
+        return np.nan
+    years = subset_cells.index.to_numpy(dtype=float)
+    sums = subset_cells['sum'].to_numpy()
+    year_mean = (count * years).sum() / n
+    value_mean = sums.sum() / n
+    means = np.divide(sums, count, out=np.zeros_like(sums), where=count > 0)
+    s_xy = ((sums - count * value_mean) * (years - year_mean)).sum()
+    s_yy = (count * (years - year_mean) ** 2).sum()
+    s_xx = subset_cells['m2'].sum() + (count * (means - value_mean) ** 2).sum()
+    if s_xx <= 0 or s_yy <= 0:
+        return np.nan
+    return float(np.clip(s_xy / np.sqrt(s_xx * s_yy), -1, 1))
+
+def ttest_std(subset_cells):
+    #standard deviation as scipy's ttest_ind sees it: a single sample has no spread
+    count = subset_cells['count'].to_numpy()
+    return np.sqrt(np.divide(subset_cells['m2'].to_numpy(), count - 1, out=np.zeros(len(count)), where=count > 1))
+
+def replace_nan_with_none(d):
+    #recursively through all nodes of stats dict and replace nan with None
+    for k, v in d.items():
+        if isinstance(v, dict):
+            replace_nan_with_none(v)
+        elif isinstance(v, float) and np.isnan(v):
+            d[k] = None
+    return d
+
+#resolution of the charts in the workbook, and of the previews shown on screen, which are displayed far smaller
+EXPORT_DPI = 300
+PREVIEW_DPI = 100
+
+#charts with more points than this are drawn decimated, see decimate()
+SCATTER_MAX_POINTS = 10_000
+#date bins the decimated series are reduced to. About the width of the chart in pixels at 300 dpi.
+SCATTER_BINS = 1_000
+
+def decimate(data, bins=SCATTER_BINS):
+    #min-max decimation over SAMPLE_DATE: the lowest and highest value in each of `bins` equal date bins,
+    #plus the first and last sample. The outline of the series and the axis limits stay the same as with every point.
+    data = data[data['REPORT_RESULT_VALUE'].notna() & data['SAMPLE_DATE'].notna()]
+    if len(data) <= 2 * bins:
+        return data
+    dates = data['SAMPLE_DATE'].to_numpy('datetime64[ns]').astype('int64')
+    first, last = dates.min(), dates.max()
+    date_bins = np.floor((dates - first) / (last - first + 1) * bins).astype(int)
+    grouped = pd.Series(data['REPORT_RESULT_VALUE'].to_numpy()).groupby(date_bins)
+    keep = np.unique(np.concatenate([grouped.idxmin(), grouped.idxmax(), [dates.argmin(), dates.argmax()]]))
+    return data.iloc[keep]
+
+@timed('scatter')
+def scatter(metal_data, name=None, single=False, max_points=None, dpi=EXPORT_DPI):
+    #every sample is drawn unless a chart would get more than max_points (SCATTER_MAX_POINTS by default),
+    #then its REF and site series are decimated
+    from matplotlib.figure import Figure
+    from matplotlib.dates import DateFormatter
+    metal_data = as_dataset(metal_data)
     if not name: name = 'scatter'
+    max_points = max_points or SCATTER_MAX_POINTS
+    images = {}
     
-    metal_ref_data = metal_data[metal_data['LOC_ID'].str.contains('REF')]
-    metal_site_data = metal_data[~metal_data['LOC_ID'].str.contains('REF')]
+    metal_ref_data = metal_data.rows(IS_REF=True)
+    metal_site_data = metal_data.rows(IS_REF=False)
     #does this data contain washed vs unwashed samples?
-    if 'WASHED' in metal_data['LOC_SUBTYPE'].unique() and not single:
+    subtypes = metal_data.values('LOC_SUBTYPE')
+    if 'WASHED' in subtypes and not single:
         #split both ref and non ref into washed and unwashed
-        metal_ref_washed_data = metal_ref_data[metal_ref_data['LOC_SUBTYPE'] == 'WASHED']
-        metal_ref_unwashed_data = metal_ref_data[metal_ref_data['LOC_SUBTYPE'].str.contains('UNWASH')]
-        metal_site_washed_data = metal_site_data[metal_site_data['LOC_SUBTYPE'] == 'WASHED']
-        metal_site_unwashed_data = metal_site_data[metal_site_data['LOC_SUBTYPE'].str.contains('UNWASH')]
-        #graph data over time but use the same y axis
-        plt.clf()
-        plt.scatter(metal_ref_unwashed_data['SAMPLE_DATE'], metal_ref_unwashed_data['REPORT_RESULT_VALUE'], label='REF Unwashed', alpha=0.5)
-        plt.scatter(metal_site_unwashed_data['SAMPLE_DATE'], metal_site_unwashed_data['REPORT_RESULT_VALUE'], label='Site Unwashed', alpha=0.5)
+        unwashed = [subtype for subtype in subtypes if 'UNWASH' in str(subtype)]
+        metal_ref_washed_data = metal_data.rows(LOC_SUBTYPE='WASHED', IS_REF=True)
+        metal_ref_unwashed_data = metal_data.rows(LOC_SUBTYPE=unwashed, IS_REF=True)
+        metal_site_washed_data = metal_data.rows(LOC_SUBTYPE='WASHED', IS_REF=False)
+        metal_site_unwashed_data = metal_data.rows(LOC_SUBTYPE=unwashed, IS_REF=False)
         #get the max value for the y axis
-        max_y = metal_data['REPORT_RESULT_VALUE'].max()
-        plt.ylim(0, max_y*1.1)
-        plt.gca().xaxis.set_major_formatter(DateFormatter('%Y'))
-        plt.legend()
-        plt.title('Unwashed')
-        plt.savefig(f'files/{name}_unwashed.png', bbox_inches='tight', dpi=300)
-        # plt.show()
-
-        plt.clf()
-        plt.scatter(metal_ref_washed_data['SAMPLE_DATE'], metal_ref_washed_data['REPORT_RESULT_VALUE'], label='REF Washed', alpha=0.5)
-        plt.scatter(metal_site_washed_data['SAMPLE_DATE'], metal_site_washed_data['REPORT_RESULT_VALUE'], label='Site Washed', alpha=0.5)
-        plt.ylim(0, max_y*1.1)
-        plt.gca().xaxis.set_major_formatter(DateFormatter('%Y'))
-        plt.legend()
-        plt.title('Washed')
-        plt.savefig(f'files/{name}_washed.png', bbox_inches='tight', dpi=300)
-        # plt.show()
+        max_y = metal_data.df['REPORT_RESULT_VALUE'].max()
+        #graph data over time but use the same y axis
+        for label, ref_data, site_data in [('Unwashed', metal_ref_unwashed_data, metal_site_unwashed_data), ('Washed', metal_ref_washed_data, metal_site_washed_data)]:
+            if len(ref_data) + len(site_data) > max_points:
+                ref_data, site_data = decimate(ref_data), decimate(site_data)
+            fig = Figure()
+            ax = fig.subplots()
+            ax.scatter(ref_data['SAMPLE_DATE'], ref_data['REPORT_RESULT_VALUE'], label=f'REF {label}', alpha=0.5)
+            ax.scatter(site_data['SAMPLE_DATE'], site_data['REPORT_RESULT_VALUE'], label=f'Site {label}', alpha=0.5)
+            ax.set_ylim(0, max_y*1.1)
+            ax.xaxis.set_major_formatter(DateFormatter('%Y'))
+            ax.legend()
+            ax.set_title(label)
+            images[f'{name}_{label.lower()}'] = save_figure(fig, dpi=dpi)
     else:
-        plt.clf()
-        plt.scatter(metal_ref_data['SAMPLE_DATE'], metal_ref_data['REPORT_RESULT_VALUE'], label='REF', alpha=0.5)
-        plt.scatter(metal_site_data['SAMPLE_DATE'], metal_site_data['REPORT_RESULT_VALUE'], label='Site', alpha=0.5)
-        plt.legend()
-        plt.gca().xaxis.set_major_formatter(DateFormatter('%Y'))
-        # plt.show()
-        #save plot image to files folder
-        plt.savefig(f'files/{name}.png', bbox_inches='tight', dpi=300)
-
-import numpy as np
-
-def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
+        if len(metal_ref_data) + len(metal_site_data) > max_points:
+            metal_ref_data, metal_site_data = decimate(metal_ref_data), decimate(metal_site_data)
+        fig = Figure()
+        ax = fig.subplots()
+        ax.scatter(metal_ref_data['SAMPLE_DATE'], metal_ref_data['REPORT_RESULT_VALUE'], label='REF', alpha=0.5)
+        ax.scatter(metal_site_data['SAMPLE_DATE'], metal_site_data['REPORT_RESULT_VALUE'], label='Site', alpha=0.5)
+        ax.legend()
+        ax.xaxis.set_major_formatter(DateFormatter('%Y'))
+        images[name] = save_figure(fig, dpi=dpi)
+
+    return images
+
+def save_figure(fig, dpi=EXPORT_DPI, bbox_inches='tight'):
+    #render a figure to an in-memory png
+    buf = BytesIO()
+    fig.savefig(buf, format='png', bbox_inches=bbox_inches, dpi=dpi)
+    buf.seek(0)
+    return buf
+
+#columns the chart functions read. Only these are shipped to the render workers.
+CHART_COLS = ['LOC_ID', 'LOC_SUBTYPE', 'SAMPLE_DATE', 'SAMPLE_YEAR', 'REPORT_RESULT_VALUE']
+
+def chart_name(metal_name, sample_type):
+    return f'{metal_name}_{sample_type}'
+
+def sheet_chart_jobs(metal_data):
+    #the charts to_sheet places for each loc_type of a chemical's Dataset (or frame), as (chart, data, name) jobs for render_charts
+    metal_data = as_dataset(metal_data)
+    metal_name = metal_data.values('CHEMICAL_NAME')[0]
+    jobs = []
+    for sample_type in metal_data.values('LOC_TYPE'):
+        metal_type_data = metal_data.subset(CHART_COLS, LOC_TYPE=sample_type)
+        name = chart_name(metal_name, sample_type)
+        jobs += [(scatter, metal_type_data, name), (siteLineChart, metal_type_data, name), (siteScatter, metal_type_data, name)]
+    return jobs
+
+def render_charts(jobs, max_workers=None, progress=None, cache=None):
+    #render (chart, data, name) jobs across a process pool. Returns one dict of png buffers keyed by image name.
+    #progress(done, total) is called as each job finishes, in job order.
+    #cache is an optional dict of png bytes kept for one dataset (e.g. one upload) by (chart, name): jobs already
+    #in it are not rendered again, however many workbooks they go into.
+    cache = {} if cache is None else cache
+    todo = [job for job in jobs if (job[0].__name__, job[2]) not in cache]
+    done = len(jobs) - len(todo)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(todo))
+    with stage('render_charts', jobs=len(todo), cached=done, workers=max_workers):
+        if max_workers < 2:
+            results = (chart(data, name) for chart, data, name in todo)
+        else:
+            #spawn rather than fork, the streamlit server is multi threaded
+            pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            results = pool_results(pool, todo)
+        for (chart, data, name), result in zip(todo, results):
+            cache[(chart.__name__, name)] = {image: buf.getvalue() for image, buf in result.items()}
+            done += 1
+            if progress:
+                progress(done, len(jobs))
+    #every caller gets its own buffers, the bytes are shared
+    return {image: BytesIO(png) for chart, data, name in jobs for image, png in cache[(chart.__name__, name)].items()}
+
+def pool_results(pool, jobs):
+    #each job's images as it finishes, in job order. Stage records from the workers are logged here.
+    with pool:
+        for result, records in pool.map(render_chart, jobs):
+            for record in records:
+                emit(record)
+            yield result
+
+def render_chart(job):
+    #runs in a worker process. The chart's stage records are sent back with its images.
+    chart, data, name = job
+    with collect() as records:
+        images = chart(data, name)
+    return images, records
+
+def build_workbook(data, output, all_stats=None, images=None, max_workers=None, progress=None, chart_cache=None):
+    #one sheet per chemical in data (a Dataset or a frame), written to output (a path or a BytesIO).
+    #Stats and charts are computed for the whole frame unless the caller already has them. chart_cache is render_charts' cache.
+    #progress(step, done, total, chemical) reports chemicals finished: step is 'stats', 'charts' or 'sheets'.
+    dataset = as_dataset(data)
+    chemicals = dataset.groups('CHEMICAL_NAME')
+    report = progress or (lambda step, done, total, chemical=None: None)
+    if all_stats is None:
+        report('stats', 0, len(chemicals))
+        all_stats = get_all_stats(dataset)
+    if images is None:
+        chart_jobs = [sheet_chart_jobs(metal_data) for metal, metal_data in chemicals]
+        #chart jobs finish in order, so a chemical's charts are done once the job count passes its last job
+        last_jobs = np.cumsum([len(jobs) for jobs in chart_jobs])
+        def charts_done(done, total):
+            finished = int(np.searchsorted(last_jobs, done, side='right'))
+            report('charts', finished, len(chemicals), chemicals[finished - 1][0] if finished else None)
+        report('charts', 0, len(chemicals))
+        images = render_charts([job for jobs in chart_jobs for job in jobs], max_workers, charts_done, chart_cache)
+    workbook = new_workbook(output)
+    for i, (metal, metal_data) in enumerate(chemicals):
+        report('sheets', i, len(chemicals), metal)
+        with stage('to_sheet', chemical=metal, rows=len(metal_data)):
+            to_sheet(metal_data, all_stats.get(metal, {}), workbook, images=images)
+    with stage('workbook_close'):
+        workbook.close()
+    report('sheets', len(chemicals), len(chemicals))
+    return output
+
+#what build_zip can make one workbook per, by option name
+SPLITS = {'chemical': 'CHEMICAL_NAME', 'loc_type': 'LOC_TYPE'}
+
+def build_zip(data, output, split='chemical', max_workers=None, progress=None, on_file=None):
+    #a zip of workbooks written to output (a path or a BytesIO): one per chemical, or one per LOC_TYPE with a sheet per chemical.
+    #Each workbook is built start to finish (stats, charts, sheets) by its own worker and goes into the zip as soon as it is done,
+    #so only the workbooks being built are held in memory and the finished ones don't wait for the rest.
+    #progress(step, done, total, name) reports workbooks finished, step is 'workbooks'.
+    #on_file(file name, workbook bytes) gets each workbook as it goes into the zip, e.g. to offer it before the zip is done.
+    #A path only appears once every workbook is in the zip, a failed build leaves nothing behind.
+    dataset = as_dataset(data)
+    parts = dataset.groups(SPLITS[split])
+    report = progress or (lambda step, done, total, name=None: None)
+    on_file = on_file or (lambda file_name, workbook: None)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(parts))
+    report('workbooks', 0, len(parts))
+    with stage('build_zip', split=split, files=len(parts), workers=max_workers):
+        if not isinstance(output, (str, os.PathLike)):
+            write_zip(output, parts, max_workers, report, on_file)
+            return output
+        #through a temporary name so a failed or half written zip never looks like a result
+        with atomic_path(output) as tmp_path:
+            write_zip(tmp_path, parts, max_workers, report, on_file)
+    return output
+
+def write_zip(output, parts, max_workers, report, on_file):
+    import zipfile
+    names = file_names([name for name, part_data in parts])
+    #xlsx files are already compressed
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        for done, (name, workbook) in enumerate(zip_workbooks(parts, max_workers), 1):
+            archive.writestr(f'{names[name]}.xlsx', workbook)
+            on_file(f'{names[name]}.xlsx', workbook)
+            report('workbooks', done, len(parts), name)
+
+def zip_workbooks(parts, max_workers):
+    #(name, workbook bytes) for each (name, Dataset) part, in the order they finish
+    if max_workers < 2:
+        for name, part_data in parts:
+            yield name, build_workbook(part_data, BytesIO(), max_workers=1).getvalue()
+        return
+    #spawn rather than fork, the streamlit server is multi threaded
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        jobs = {pool.submit(part_workbook, part_data): name for name, part_data in parts}
+        for job in as_completed(jobs):
+            #drop the future so its workbook is freed once it is in the zip
+            name = jobs.pop(job)
+            workbook, records = job.result()
+            for record in records:
+                emit(record)
+            yield name, workbook
+
+def part_workbook(part_data):
+    #runs in a worker process. Charts render in this worker only, the pool is already one process per workbook.
+    with collect() as records:
+        workbook = build_workbook(part_data, BytesIO(), max_workers=1).getvalue()
+    return workbook, records
+
+def file_names(names):
+    #{name: file name} for chemicals or LOC_TYPEs, safe inside a zip. Names that come out the same (ignoring case,
+    #for case insensitive file systems) are numbered like cli.output_paths does.
+    files = {}
+    used = set()
+    for name in names:
+        stem = re.sub(r'[^\w\-. ]', '_', str(name)).strip() or 'blank'
+        file, i = stem, 1
+        while file.lower() in used:
+            i += 1
+            file = f'{stem}_{i}'
+        used.add(file.lower())
+        files[name] = file
+    return files
+
+def new_workbook(output):
+    import xlsxwriter
+    #rows are streamed to a temporary file per sheet as soon as a later row is written, so memory stays flat
+    #however large the sheets get. Everything on a sheet has to be written in row order (set_row before the row's cells).
+    return xlsxwriter.Workbook(output, {'constant_memory': True})
+
+#formats already added to each open workbook, keyed by their properties
+_formats = WeakKeyDictionary()
+
+def get_format(workbook, **properties):
+    #one shared Format per distinct set of properties in a workbook, however many sheets use it
+    formats = _formats.setdefault(workbook, {})
+    key = tuple(sorted(properties.items()))
+    if key not in formats:
+        formats[key] = workbook.add_format(properties)
+    return formats[key]
+
+def decimal_places(values):
+    #largest number of decimals any value is written with (str(value)), looking at each distinct value once
+    text = pd.Series(pd.unique(np.asarray(values))).astype(str)
+    decimals = text.str.partition('.')[2].str.len()
+    return int(decimals.max()) if len(decimals) else 0
+
+def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False, images=None):
+    #one chemical's sheet. metal_data is the chemical's Dataset, or its frame.
+    metal_data = as_dataset(metal_data)
     current_path = os.path.dirname(os.path.abspath(__file__))
     if not workbook:
         single_sheet = True
         filename =  os.path.join(current_path, "files/output.xlsx")
-        workbook = xlsxwriter.Workbook(filename)
-    metal_name = metal_data['CHEMICAL_NAME'].unique()[0]
+        #nothing else creates files/ any more
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        workbook = new_workbook(filename)
+    metal_name = metal_data.values('CHEMICAL_NAME')[0]
+    #render all of this chemical's charts up front unless the caller already rendered the whole workbook
+    if images is None:
+        images = render_charts(sheet_chart_jobs(metal_data))
     sheet = workbook.add_worksheet(metal_name.capitalize())
     
     #set first column extra wide
@@ -155,33 +449,39 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
     #set all columns to 20 width
     sheet.set_column(1, 100, 18)
     #warning with a soft yellow background
-    format_fill = workbook.add_format({'bg_color': '#DCE6F1'})
-    format_italic = workbook.add_format({'italic': True, 'font_size': 9})
-    format_bold = workbook.add_format({'bold': True})
+    format_fill = get_format(workbook, bg_color='#DCE6F1')
+    #italic and size 9
+    format_italic = get_format(workbook, italic=True, font_size=9)
+    format_bold = get_format(workbook, bold=True)
+    format_good = get_format(workbook, bg_color='#C6EFCE')
+    format_bad = get_format(workbook, bg_color='#FFC7CE')
     #what is the largest number of decimals in the data?
-    decimals = metal_data['REPORT_RESULT_VALUE'].apply(lambda x: len(str(x).split('.')[1]) if '.' in str(x) else 0).max()
-    decimals = max(decimals, 2)
+    decimals = max(decimal_places(metal_data.df['REPORT_RESULT_VALUE']), 2)
     number_format = f'#,##0.{decimals * "0"}'
-    format_warning = workbook.add_format({'bg_color': '#f5ed9e', 'num_format': number_format})
-    number_format = workbook.add_format({'num_format': number_format})
-    workbook.add_format()
-    #italic and size 9
+    format_warning = get_format(workbook, bg_color='#f5ed9e', num_format=number_format)
+    number_format = get_format(workbook, num_format=number_format)
     
     #Metal Name
     sheet.write(0, 0, metal_name.capitalize(), format_fill)
     #get the unit type (REPORT_RESULT_UNIT)
-    unit_type = metal_data['REPORT_RESULT_UNIT'].unique()[0]
+    unit_type = metal_data.df['REPORT_RESULT_UNIT'].unique()[0]
 
     sheet.write(1, 0, unit_type, format_italic)
 
+    #yearly means and trends of every location of the chemical, all locations in one batch. write_data takes its rows from these.
+    location_data = metal_data.df.assign(LOC_NAME=location_names(metal_data.df))
+    location_means = location_year_means(location_data)
+    location_trends = mann_kendall(location_means)
+    format_count = get_format(workbook, num_format='0')
+
     row, col = 2, 0
     for sample_type, stats in metal_stats.items():
         #Sample Type
         #get number of years in data
-        years = metal_data['SAMPLE_YEAR'].unique()
+        years = metal_data.df['SAMPLE_YEAR'].unique()
         num_years = len(years)
         #Group/Merge Cells
-        num_cols = max([num_years + 1, 15])
+        num_cols = max([num_years + 4, 15])
         sheet.merge_range(row, col, row, num_cols, sample_type.upper(), format_fill)
         row += 2
 
@@ -212,8 +512,6 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
         sheet.write_row(row, col+1, ['p-value', 't-test'])
         row += 1
 
-        format_good = workbook.add_format({'bg_color': '#C6EFCE'})
-        format_bad = workbook.add_format({'bg_color': '#FFC7CE'})
         if not latest_stats['washed_ttest']['p']:
             sheet.write(row, col, 'Not enough Washed data for t test')
         else:
@@ -237,21 +535,24 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
         row += 2
 
         #Charts
-        metal_type_data = metal_data[metal_data['LOC_TYPE'] == sample_type]
-        scatter(metal_type_data, sample_type)
-        siteLineChart(metal_type_data, sample_type)
-        siteScatter(metal_type_data, sample_type)
+        name = chart_name(metal_name, sample_type)
+
+        def insert_chart(row, col, image, options):
+            #charts come from render_charts as in-memory pngs. Skip any chart the data didn't produce.
+            if image in images:
+                images[image].seek(0)
+                sheet.insert_image(row, col, f'{image}.png', {'image_data': images[image], **options})
         
         # add image to sheet
         if sample_type == 'SOIL':
-            sheet.insert_image(row, col+1, f'files/{sample_type}.png', {'x_scale': 0.65, 'y_scale': 0.65})
+            insert_chart(row, col+1, name, {'x_scale': 0.65, 'y_scale': 0.65})
             col += 4
         else:
-            sheet.insert_image(row, col+1, f'files/{sample_type}_washed.png', {'x_scale': 0.65, 'y_scale': 0.65})
-            sheet.insert_image(row, col+4, f'files/{sample_type}_unwashed.png', {'x_scale': 0.65, 'y_scale': 0.65})
+            insert_chart(row, col+1, f'{name}_washed', {'x_scale': 0.65, 'y_scale': 0.65})
+            insert_chart(row, col+4, f'{name}_unwashed', {'x_scale': 0.65, 'y_scale': 0.65})
             col += 7
-        sheet.insert_image(row, col, f'files/{sample_type}_site_scatter.png', {'x_scale': 0.65, 'y_scale': 0.55})
-        sheet.insert_image(row, col+3, f'files/{sample_type}_site_line.png', {'x_scale': 0.65, 'y_scale': 0.65})
+        insert_chart(row, col, f'{name}_site_scatter', {'x_scale': 0.65, 'y_scale': 0.55})
+        insert_chart(row, col+3, f'{name}_site_line', {'x_scale': 0.65, 'y_scale': 0.65})
         col = 0
 
         
@@ -265,6 +566,9 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
             #Site
             sheet.write(row, col, f'Historic - {subtype}', format_bold)
             sheet.write_row(row, col+2, years, format_bold)
+            #group the historic data in excel. Rows are written in order, so the grouping is set before them.
+            for i in range(1, 9):
+                sheet.set_row(row+i, None, None, {'level': 1, 'hidden': True})
             row += 1
             sheet.write(row, col, 'Site Sample Count')
             sheet.write_row(row, col+2, [site[year]['count'] for year in years])
@@ -301,11 +605,6 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
             row += 1
             sheet.write(row, col, 'Site vs Ref T-Test p-value')
             sheet.write_row(row, col+2, [ttest[year]['p'] for year in years], number_format)
-                       
-            #group the historic data in excel
-            for i in range(8):
-                sheet.set_row(row-i, None, None, {'level': 1, 'hidden': True})
-            
             row += 1
             return (row, col)
 
@@ -325,47 +624,41 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
         row += 2
 
         def write_data(metal_df, years, subtype, row, col):
+            #years start in the same column as in the historic rows above, the trend of each location comes after them
+            trend_col = col+2+len(years)
             sheet.write_row(row, col, ['Site Data '+subtype.capitalize() , 'Time Correlation'], format_bold)
             sheet.write_row(row, col+2, years, format_bold)
+            sheet.write_row(row, trend_col, ['Mann-Kendall S', 'Mann-Kendall p-value', "Sen's Slope (per year)"], format_bold)
             row += 1
-            #get loc name by combining LOC_ID and LOC_TYPE. Sort by LOC ID
-
-            metal_df['LOC_NAME'] = metal_df['LOC_ID'].astype(str) + ' ' + metal_df['LOC_TYPE'] + ' ' + metal_df['LOC_SUBTYPE']
-            metal_df = metal_df.sort_values(by=['LOC_ID'])
-            #for each location, write the data
-
-            for loc_name, loc_df in metal_df.groupby('LOC_NAME'):
-                #get the time correlation over the years, if we have more than 2 values
-                time_corr = loc_df['REPORT_RESULT_VALUE'].corr(loc_df['SAMPLE_YEAR'])
-                time_corr = time_corr if not np.isnan(time_corr) else ''
-                time_corr = time_corr if (len(loc_df['REPORT_RESULT_VALUE']) > 2) else ''
-                #write the location name
-                sheet.write(row, col, loc_name)
-                sheet.write(row, col+1, time_corr, number_format)
-                #write the data by year
-                for year in years:
-                    mean = loc_df[loc_df['SAMPLE_YEAR'] == year]['REPORT_RESULT_VALUE'].mean()
-                    #convert nan to None
-                    mean = mean if not np.isnan(mean) else ''
-                    sheet.write(row, col+2, mean, number_format)
-                    col += 1
+            #get loc name by combining LOC_ID and LOC_TYPE
+            metal_df = metal_df.assign(LOC_NAME=location_names(metal_df))
+
+            #location x year table of means, and the time correlation and trend of each location, for all locations at once
+            means = location_means.reindex(index=sorted(metal_df['LOC_NAME'].dropna().unique()), columns=years)
+            time_corr = location_time_correlation(metal_df).reindex(means.index)
+            #only show the time correlation if we have more than 2 values
+            time_corr[metal_df.groupby('LOC_NAME').size().reindex(means.index) <= 2] = np.nan
+            trend = location_trends.reindex(means.index)
+            #write the data by year, one row per location. Missing values are blank.
+            table = pd.concat([time_corr, means, trend], axis=1).astype(object).where(lambda x: x.notna(), '')
+            for loc_name, values in zip(table.index, table.values.tolist()):
                 sheet.set_row(row, None, None, {'level': 1, 'hidden': True})
-
+                sheet.write(row, col, loc_name)
+                sheet.write_row(row, col+1, values[:1+len(years)], number_format)
+                sheet.write(row, trend_col, values[1+len(years)], format_count)
+                sheet.write_row(row, trend_col+1, values[2+len(years):], number_format)
                 row += 1
-                col = 0
             
             return row
 
-
         #Site data washed over time
-        metal_type_data = metal_data[metal_data['LOC_TYPE'] == sample_type]
-        washed = metal_type_data[metal_type_data['LOC_SUBTYPE'] == 'WASHED']
+        washed = metal_data.rows(LOC_TYPE=sample_type, LOC_SUBTYPE='WASHED')
         row = write_data(washed, years, 'Washed', row, col)
 
         #site data unwashed over time
         row += 1
         col = 0
-        unwashed = metal_type_data[metal_type_data['LOC_SUBTYPE'] == 'UNWASH']
+        unwashed = metal_data.rows(LOC_TYPE=sample_type, LOC_SUBTYPE='UNWASH')
         row = write_data(unwashed, years, 'Unwashed', row, col)
         
         row += 2
@@ -375,89 +668,113 @@ def to_sheet(metal_data, metal_stats, workbook=None, single_sheet=False):
     else:
         return workbook
 
+def location_names(metal_df):
+    #LOC_ID, LOC_TYPE and LOC_SUBTYPE, the name a location's rows are shown under
+    return metal_df['LOC_ID'].astype(str) + ' ' + metal_df['LOC_TYPE'].astype(str) + ' ' + metal_df['LOC_SUBTYPE'].astype(str)
+
+def location_year_means(metal_df, years=None):
+    #mean value of each LOC_NAME (rows, sorted) in each of the given years (columns), every year in the data by default
+    means = metal_df.groupby(['LOC_NAME', 'SAMPLE_YEAR'])['REPORT_RESULT_VALUE'].mean().unstack()
+    loc_names = metal_df['LOC_NAME'].dropna().unique()
+    return means.reindex(index=sorted(loc_names), columns=sorted(means.columns) if years is None else years)
+
+def location_time_correlation(metal_df):
+    #pearson correlation of value with SAMPLE_YEAR for every LOC_NAME, from grouped sums of deviations
+    data = metal_df[['LOC_NAME', 'SAMPLE_YEAR', 'REPORT_RESULT_VALUE']].dropna()
+    grouped = data.groupby('LOC_NAME')
+    dx = data['REPORT_RESULT_VALUE'] - grouped['REPORT_RESULT_VALUE'].transform('mean')
+    dy = data['SAMPLE_YEAR'] - grouped['SAMPLE_YEAR'].transform('mean')
+    sums = pd.DataFrame({'xy': dx * dy, 'xx': dx ** 2, 'yy': dy ** 2}).groupby(data['LOC_NAME']).sum()
+    denominator = np.sqrt(sums['xx'] * sums['yy'])
+    return (sums['xy'] / denominator.where(denominator > 0)).clip(-1, 1)
+
 def siteLineChartSns(metal_data, name='site_line_chart'):
     import seaborn as sns
+    from matplotlib.figure import Figure
 
     #create figure and axis
-    fig, ax = plt.subplots()
+    fig = Figure()
+    ax = fig.subplots()
 
     #Line chart of site data over time. Each site is a line.
     sns.lineplot(data=metal_data, x='SAMPLE_YEAR', y='REPORT_RESULT_VALUE', hue='LOC_ID', ci=None, ax=ax)
 
     ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
-    plt.savefig(f'files/{name}.png')
-    # plt.show()
+    return {name: save_figure(fig, dpi=fig.dpi, bbox_inches=None)}
 
     
-def siteScatter(metal_data, name='site_scatter'):
-    #loc_xname to be the loc_id and first letter of subtype
-    metal_data['LOC_XNAME'] = metal_data['LOC_ID'].astype(str) + ' ' + metal_data['LOC_SUBTYPE'].str[0]
-
-    #sort loc_xname
-    metal_data = metal_data.sort_values(by=['LOC_XNAME'])
+@timed('siteScatter')
+def siteScatter(metal_data, name='site_scatter', dpi=EXPORT_DPI):
+    import re
+    from matplotlib.figure import Figure
+    metal_data = as_dataset(metal_data)
     # show washed in blue, unwashed in orange
-    washed = metal_data[metal_data['LOC_SUBTYPE'] == 'WASHED']
-    unwashed = metal_data[metal_data['LOC_SUBTYPE'] == 'UNWASH']
-    #sort by LOC_XNAME
-    washed = washed.sort_values(by=['LOC_XNAME'])
-    unwashed = unwashed.sort_values(by=['LOC_XNAME'])
+    washed = metal_data.rows(LOC_SUBTYPE='WASHED')
+    unwashed = metal_data.rows(LOC_SUBTYPE='UNWASH')
+    #loc_xname to be the loc_id and first letter of subtype
+    washed = washed.assign(LOC_XNAME=washed['LOC_ID'].astype(str) + ' W')
+    unwashed = unwashed.assign(LOC_XNAME=unwashed['LOC_ID'].astype(str) + ' U')
     #X axis should be unique site name. Washed is blue, unwashed is orange.
-    sites = metal_data['LOC_XNAME'].unique()
+    #Alphabetical first, so the numeric sort below keeps a site's U and W together and sites without a number in order.
+    sites = sorted(pd.concat([unwashed['LOC_XNAME'], washed['LOC_XNAME']]).unique())
 
     #sort sites. Note that lox_xname can have a string and number. It should be sorted by number unless there is no number in the string.
-    import re
     try:
         sites = sorted(sites, key=lambda x: int(re.search(r'\d+', x).group()) if re.search(r'\d+', x) else 0)
     except:
         sites = sorted(sites)
 
-    fig, ax = plt.subplots()
-    plt.xticks(rotation=90)
+    fig = Figure()
+    ax = fig.subplots()
+    ax.tick_params(axis='x', labelrotation=90)
 
-    for site in sites:
-        #on the first site, label the series
-        site_unwashed = unwashed[unwashed['LOC_XNAME'] == site]
-        site_washed = washed[washed['LOC_XNAME'] == site]
-        
-        if site == sites[0]:
-            ax.scatter(site_unwashed['LOC_XNAME'], site_unwashed['REPORT_RESULT_VALUE'], color='tab:orange', alpha=0.5, label='Unwashed')
-            ax.scatter(site_washed['LOC_XNAME'], site_washed['REPORT_RESULT_VALUE'], color='tab:blue', alpha=0.5, label='Washed')
-        else:
-            ax.scatter(site_unwashed['LOC_XNAME'], site_unwashed['REPORT_RESULT_VALUE'], color='tab:orange', alpha=0.5)
-            ax.scatter(site_washed['LOC_XNAME'], site_washed['REPORT_RESULT_VALUE'], color='tab:blue', alpha=0.5)
+    #one scatter per series, whatever the number of sites. The sites are registered as
+    #categories up front so the x axis keeps the sorted order rather than the order the points come in.
+    if sites:
+        ax.xaxis.update_units(np.asarray(sites))
+    if len(metal_data):
+        ax.scatter(unwashed['LOC_XNAME'], unwashed['REPORT_RESULT_VALUE'], color='tab:orange', alpha=0.5, label='Unwashed')
+        ax.scatter(washed['LOC_XNAME'], washed['REPORT_RESULT_VALUE'], color='tab:blue', alpha=0.5, label='Washed')
 
     # title of chemical name 
     ax.set_title('By Site')
     ax.legend()
     
-    plt.savefig(f'files/{name}_site_scatter.png', bbox_inches='tight', dpi=300)
-    # plt.show()
-
-
-
-def siteLineChart(metal_data, name='site_line_chart'):
-    #Line chart of site data over time. Each site is a line.
-    sites = metal_data['LOC_ID'].unique()
+    return {f'{name}_site_scatter': save_figure(fig, dpi=dpi)}
+
+#sites named in the site line chart legend, the rest are summarised in one entry
+LEGEND_SITES = 30
+
+@timed('siteLineChart')
+def siteLineChart(metal_data, name='site_line_chart', dpi=EXPORT_DPI):
+    #Line chart of site data over time. Each site is a line, one point per year being the mean.
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+    metal_data = as_dataset(metal_data).df
+    means = metal_data.groupby(['LOC_ID', 'SAMPLE_YEAR'], observed=True, sort=True)['REPORT_RESULT_VALUE'].mean()
+    #sites in the order they appear in the data, years sorted within each site
+    site_means = {site: site_data.droplevel('LOC_ID') for site, site_data in means.groupby(level='LOC_ID', observed=True, sort=False)}
+    sites = [site for site in metal_data['LOC_ID'].unique() if site in site_means]
 
     #create figure and axis
-    fig, ax = plt.subplots()
-
-    for site in sites:
-        site_data = metal_data[metal_data['LOC_ID'] == site]
-        #we want x axis to be year, but only one data point per year, being the mean.
-        years = site_data['SAMPLE_YEAR'].unique()
-        #sort years
-        years = sorted(years)
-        #get the mean of each year
-        means = []
-        for year in years:
-            means.append(site_data[site_data['SAMPLE_YEAR'] == year]['REPORT_RESULT_VALUE'].mean())
-        #plot the line
-        ax.plot(years, means, label=site)
+    fig = Figure()
+    ax = fig.subplots()
+
+    #all sites go into one LineCollection, so the artist count doesn't grow with the number of sites
+    colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+    colors = [colors[i % len(colors)] for i in range(len(sites))]
+    segments = [np.column_stack([site_means[site].index.to_numpy(float), site_means[site].to_numpy(float)]) for site in sites]
+    if segments:
+        ax.add_collection(LineCollection(segments, colors=colors))
+        ax.autoscale_view()
 
     #move legend outside of graph area
-    ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
+    handles = [Line2D([], [], color=color, label=site) for site, color in zip(sites[:LEGEND_SITES], colors)]
+    if len(sites) > LEGEND_SITES:
+        handles.append(Line2D([], [], linestyle='none', label=f'... {len(sites) - LEGEND_SITES} more sites'))
+    ax.legend(handles=handles, bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
     ax.set_title('Sites Over Time')
     
-    plt.savefig(f'files/{name}_site_line.png', bbox_inches='tight', dpi=300)
-    # plt.show()
+    return {f'{name}_site_line': save_figure(fig, dpi=dpi)}
@@ -0,0 +1,80 @@
+import os
+from io import StringIO
+import hashlib
+import pandas as pd
+from atomic import atomic_path
+from stat_functions import cell_stats, combine_cells, all_stats_from_cells
+from ingest import REQUIRED_COLS
+
+#Persisted statistics so a new year of samples can be added without re-reading the full history.
+#The state is the cell_stats table for every (chemical, LOC_TYPE, year, subtype, ref/site) cell:
+#sample count, sum and sum of squared deviations. That is enough to rebuild every mean, std and t-test,
+#and because the year is constant within a cell, the all-time correlations with year as well.
+#The file also lists a hash of every batch folded in, one '#batch <hash> <name>' line each above the cells, so the same
+#rows are never counted twice. Cells and batches are replaced together in one step: a crash leaves the old state whole.
+#  python cli.py batch_2024.csv --state stats_state.csv
+
+STATE_KEYS = ['CHEMICAL_NAME', 'LOC_TYPE', 'SAMPLE_YEAR', 'LOC_SUBTYPE', 'IS_REF']
+STATE_COLS = ['size', 'count', 'sum', 'var', 'm2']
+
+class BatchApplied(ValueError):
+    pass
+
+BATCH_PREFIX = '#batch '
+
+def read_state(path):
+    #(cells, {batch id: name}) saved by save_state, or (None, {}) if there is no state yet
+    if not os.path.exists(path):
+        return None, {}
+    batches = {}
+    with open(path, newline='') as f:
+        line = f.readline()
+        while line.startswith(BATCH_PREFIX):
+            batch, name = line[len(BATCH_PREFIX):].rstrip('\r\n').split(' ', 1)
+            batches[batch] = name
+            line = f.readline()
+        #keys are text as written. Chemical names like NA must not turn into missing values, only blanks are missing
+        #(rows without a year or subtype have cells of their own).
+        cells = pd.read_csv(StringIO(line + f.read()), dtype={'CHEMICAL_NAME': str, 'LOC_TYPE': str, 'LOC_SUBTYPE': str},
+                            keep_default_na=False, na_values={'var': [''], 'SAMPLE_YEAR': [''], 'LOC_SUBTYPE': ['']}, float_precision='round_trip')
+    cells['IS_REF'] = cells['IS_REF'].astype(str) == 'True'
+    return cells.set_index(STATE_KEYS)[STATE_COLS], batches
+
+def load_state(path):
+    #cells saved by save_state, or None if there is no state yet
+    return read_state(path)[0]
+
+def save_state(cells, path, batches=None):
+    #batches is {batch id: name} of every batch in cells
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'w', newline='') as f:
+            for batch, name in (batches or {}).items():
+                f.write(f'{BATCH_PREFIX}{batch} {name}\n')
+            cells[STATE_COLS].to_csv(f)
+
+def batch_id(df):
+    #hash of a batch's rows, the same however the file was read (csv or xlsx, categorical or not)
+    hashes = pd.util.hash_pandas_object(df[[col for col in REQUIRED_COLS if col in df.columns]], index=False)
+    return hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()
+
+def update_state(path, new_data, name=''):
+    #fold new rows (e.g. this year's batch, already read with ingest.read_data) into the saved state.
+    #Returns the updated get_all_stats dict. Rows for a year already in the state are added to it, not replaced.
+    #Raises BatchApplied if the same rows were already folded in. name is only recorded, to say which file that was.
+    batch = batch_id(new_data)
+    state, batches = read_state(path)
+    if batch in batches:
+        raise BatchApplied(f"This batch is already in the state ({batches[batch] or batch[:12]})")
+    cells = cell_stats(new_data, ['CHEMICAL_NAME', 'LOC_TYPE'])
+    cells.index = cells.index.set_levels([level.astype(object) for level in cells.index.levels])
+    if state is not None:
+        cells = combine_cells(state, cells)
+    save_state(cells, path, {**batches, batch: ' '.join(name.split())})
+    return all_stats_from_cells(cells)
+
+def get_state_stats(path):
+    #get_all_stats from the saved state alone
+    state = load_state(path)
+    if state is None:
+        return {}
+    return all_stats_from_cells(state)
@@ -0,0 +1,66 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from export import STATS_COLUMNS, STATS_FORMATS, stats_table, write_stats
+from stat_functions import get_all_stats
+from test_stats import sample_data
+
+KEYS = ['chemical', 'loc_type', 'year', 'subtype', 'location']
+
+@pytest.fixture(scope='module')
+def table():
+    df = sample_data()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return stats_table(get_all_stats(df)), df
+
+def test_one_row_per_subset_and_year(table):
+    table, df = table
+    assert list(table.columns) == STATS_COLUMNS
+    assert not table.duplicated(KEYS).any()
+    #every year of every (chemical, loc_type) has the four ref/site x washed/unwashed rows
+    years = df.dropna(subset=['SAMPLE_YEAR']).groupby(['CHEMICAL_NAME', 'LOC_TYPE'], observed=True)['SAMPLE_YEAR'].nunique()
+    assert len(table) == 4 * years.sum()
+    assert set(zip(table['subtype'], table['location'])) == {('WASHED', 'ref'), ('WASHED', 'site'), ('UNWASH', 'ref'), ('UNWASH', 'site')}
+
+def test_column_types(table):
+    table, df = table
+    assert table.dtypes.astype(str).to_dict() == {
+        'chemical': 'object', 'loc_type': 'object', 'year': 'int64', 'subtype': 'object', 'location': 'object', 'count': 'int64',
+        'mean': 'float64', 'std': 'float64', 't': 'float64', 'p': 'float64', 'significant': 'boolean'}
+    #no p-value, no verdict
+    assert (table['significant'].isna() == table['p'].isna()).all()
+
+def read_stats(path, file_type):
+    #pandas' default float parsing is off in the last digit, these read the numbers exactly as written
+    if file_type == 'csv':
+        return pd.read_csv(path, float_precision='round_trip')
+    if file_type == 'json':
+        return pd.read_json(path, orient='records', precise_float=True)
+    return pd.read_parquet(path)
+
+@pytest.mark.parametrize('file_type', STATS_FORMATS)
+def test_round_trip(table, tmp_path, file_type):
+    table, df = table
+    path = str(tmp_path / f'stats.{file_type}')
+    write_stats(table, path)
+    back = read_stats(path, file_type)
+    assert list(back.columns) == STATS_COLUMNS
+    for col in KEYS + ['count']:
+        assert back[col].astype(str).tolist() == table[col].astype(str).tolist()
+    #the same numbers in every format, to the last digit
+    for col in ['mean', 'std', 't', 'p']:
+        np.testing.assert_array_equal(back[col].astype(float), table[col])
+    assert back['significant'].astype('boolean').equals(table['significant'])
+
+def test_json_keeps_tiny_numbers(tmp_path):
+    table = pd.DataFrame({'p': [1e-20, 0.123456789012345678]})
+    write_stats(table, str(tmp_path / 'stats.json'))
+    assert pd.read_json(tmp_path / 'stats.json', orient='records', precise_float=True)['p'].tolist() == [1e-20, 0.123456789012345678]
+
+def test_unknown_format(table, tmp_path):
+    with pytest.raises(ValueError):
+        write_stats(table[0], str(tmp_path / 'stats.txt'))
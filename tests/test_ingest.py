@@ -0,0 +1,15 @@
+from io import BytesIO
+
+from dataset import Dataset
+from ingest import read_data
+from test_stats import sample_data
+
+def test_chunked_csv_keeps_sorted_order():
+    df = sample_data(rows=60)
+    #chemicals in reverse order, so chunk by chunk they are first seen unsorted
+    df = df.sort_values('CHEMICAL_NAME', ascending=False, key=lambda names: names.astype(str))
+    csv = df.to_csv(index=False, date_format='%m/%d/%Y').encode()
+    whole = Dataset(read_data(BytesIO(csv), 'upload.csv'))
+    chunked = Dataset(read_data(BytesIO(csv), 'upload.csv', chunksize=1))
+    assert [name for name, part in chunked.groups('CHEMICAL_NAME')] == ['ARSENIC', 'COPPER', 'LEAD', 'ZINC']
+    assert [name for name, part in chunked.groups('LOC_TYPE')] == [name for name, part in whole.groups('LOC_TYPE')]
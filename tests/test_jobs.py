@@ -0,0 +1,20 @@
+import pytest
+
+from jobs import new_registry, submit
+
+def test_failed_job_is_started_again():
+    registry = new_registry()
+    calls = []
+    def work(progress, add_file):
+        calls.append(1)
+        if len(calls) == 1:
+            raise MemoryError('first run fails')
+        return 'done'
+    job = submit(registry, 'key', work)
+    with pytest.raises(MemoryError):
+        job['future'].result()
+    retry = submit(registry, 'key', work)
+    assert retry is not job and retry['future'].result() == 'done'
+    #a finished job that worked is shared
+    assert submit(registry, 'key', work) is retry
+    assert len(calls) == 2
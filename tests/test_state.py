@@ -0,0 +1,49 @@
+import warnings
+
+import pandas as pd
+import pytest
+
+from stat_functions import get_all_stats
+from stats_state import BatchApplied, get_state_stats, update_state
+from test_stats import assert_same, sample_data
+
+def test_batches_add_up_to_the_whole(tmp_path):
+    df = sample_data()
+    path = str(tmp_path / 'state.csv')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        update_state(path, df.iloc[:1000], 'first.csv')
+        update_state(path, df.iloc[1000:], 'second.csv')
+        assert_same(get_state_stats(path), get_all_stats(df))
+
+def test_same_batch_is_not_added_twice(tmp_path):
+    df = sample_data()
+    path = str(tmp_path / 'state.csv')
+    update_state(path, df, 'batch.csv')
+    with open(path) as f:
+        saved = f.read()
+    with pytest.raises(BatchApplied):
+        update_state(path, df.copy(), 'batch_again.csv')
+    with open(path) as f:
+        assert f.read() == saved
+
+def test_failed_save_leaves_the_state_as_it_was(tmp_path, monkeypatch):
+    df = sample_data()
+    path = str(tmp_path / 'state.csv')
+    update_state(path, df.iloc[:1000], 'first.csv')
+    with open(path) as f:
+        saved = f.read()
+    def crash(*args, **kwargs):
+        raise OSError('disk full')
+    with monkeypatch.context() as patch:
+        patch.setattr(pd.DataFrame, 'to_csv', crash)
+        with pytest.raises(OSError):
+            update_state(path, df.iloc[1000:], 'second.csv')
+    with open(path) as f:
+        assert f.read() == saved
+    assert [p.name for p in tmp_path.iterdir()] == ['state.csv']
+    #the batch was not recorded, so it can still be added
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        update_state(path, df.iloc[1000:], 'second.csv')
+        assert_same(get_state_stats(path), get_all_stats(df))
@@ -0,0 +1,100 @@
+import warnings
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import ttest_ind
+
+from dataset import Dataset
+from ingest import prepare, stream_stats
+from stat_functions import SUBSETS, get_all_stats, get_metal_stats
+
+#get_all_stats against the stats computed the slow way: every subset selected from the rows and
+#passed to Series.mean/std/corr and scipy's ttest_ind.
+
+def reference_stats(metal_data):
+    ref = metal_data['LOC_ID'].astype(str).str.contains('REF')
+    subsets = {name: metal_data[(metal_data['LOC_SUBTYPE'] == subtype) & (ref == is_ref)] for name, (subtype, is_ref) in SUBSETS.items()}
+    stats = {'historic': {}, 'latest': {}, 'all_time': {'correlation': {}, 'mean': {}}}
+    for name, data in subsets.items():
+        stats['all_time']['correlation'][name] = data['REPORT_RESULT_VALUE'].corr(data['SAMPLE_YEAR'])
+        stats['all_time']['mean'][name] = data['REPORT_RESULT_VALUE'].mean()
+    years = sorted(metal_data['SAMPLE_YEAR'].dropna().unique())
+    for year in years:
+        year_data = {name: data[data['SAMPLE_YEAR'] == year]['REPORT_RESULT_VALUE'] for name, data in subsets.items()}
+        year_stats = {name: {'count': len(values), 'mean': values.mean(), 'std': values.std()} for name, values in year_data.items()}
+        for subtype in ['washed', 'unwashed']:
+            t, p = ttest_ind(year_data[f'{subtype}_ref'], year_data[f'{subtype}_site'])
+            year_stats[f'{subtype}_ttest'] = {'t': t, 'p': p, 'significant': p < 0.05}
+        stats['historic'][int(year)] = year_stats
+    if years:
+        #latest is the last year's dict itself, so the year shows in historic too
+        stats['latest'] = stats['historic'][int(years[-1])]
+        stats['latest']['year'] = int(years[-1])
+    return stats
+
+def reference_all_stats(df):
+    all_stats = {}
+    for metal in df['CHEMICAL_NAME'].dropna().unique():
+        metal_data = df[df['CHEMICAL_NAME'] == metal]
+        all_stats[metal] = {loc_type: reference_stats(metal_data[metal_data['LOC_TYPE'] == loc_type]) for loc_type in metal_data['LOC_TYPE'].dropna().unique()}
+    return all_stats
+
+def assert_same(got, expected, path=''):
+    if isinstance(expected, dict):
+        assert set(got) == set(expected), path
+        for key in expected:
+            assert_same(got[key], expected[key], f'{path}/{key}')
+    elif expected is None or (isinstance(expected, float) and np.isnan(expected)):
+        assert got is None, path
+    elif isinstance(expected, (bool, np.bool_)):
+        assert bool(got) == bool(expected), path
+    else:
+        assert got == pytest.approx(expected, rel=1e-9, abs=1e-12), path
+
+def sample_data(seed=0, rows=2000):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'LOC_ID': rng.choice(['REF-1', 'REF-2', 'SITE-1', 'SITE-2', 'SITE-3'], rows),
+        'LOC_TYPE': rng.choice(['LICHEN', 'VEG', 'SOIL'], rows),
+        'LOC_SUBTYPE': rng.choice(['WASHED', 'UNWASH'], rows),
+        'CHEMICAL_NAME': rng.choice(['ARSENIC', 'LEAD', 'ZINC'], rows),
+        'REPORT_RESULT_VALUE': rng.gamma(2, 50, rows).round(3),
+        'REPORT_RESULT_UNIT': 'mg/kg',
+        'SAMPLE_DATE': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 6 * 365, rows), unit='D'),
+    })
+    #soil has no washed/unwashed split, and some rows have no value or no date
+    df.loc[df['LOC_TYPE'] == 'SOIL', 'LOC_SUBTYPE'] = np.nan
+    df.loc[rng.random(rows) < 0.02, 'REPORT_RESULT_VALUE'] = np.nan
+    df.loc[rng.random(rows) < 0.02, 'SAMPLE_DATE'] = pd.NaT
+    #a year with one ref value and one missing ref value
+    extra = pd.DataFrame({
+        'LOC_ID': ['REF-1', 'REF-1', 'SITE-1', 'SITE-1', 'SITE-2'],
+        'LOC_TYPE': 'VEG', 'LOC_SUBTYPE': 'WASHED', 'CHEMICAL_NAME': 'COPPER',
+        'REPORT_RESULT_VALUE': [6.0, np.nan, 5.0, 7.0, 9.0], 'REPORT_RESULT_UNIT': 'mg/kg',
+        'SAMPLE_DATE': pd.Timestamp('2020-06-01'),
+    })
+    return prepare(pd.concat([df, extra], ignore_index=True))
+
+def stats_from_csv(df):
+    csv = df.to_csv(index=False, date_format='%m/%d/%Y').encode()
+    return stream_stats(BytesIO(csv), chunksize=300)
+
+@pytest.mark.parametrize('stats', [get_all_stats, lambda df: get_all_stats(Dataset(df)), stats_from_csv], ids=['frame', 'dataset', 'stream'])
+def test_all_stats_match_reference(stats):
+    df = sample_data()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = reference_all_stats(df)
+        got = stats(df)
+    assert_same(got, expected)
+
+def test_soil_without_subtypes_is_kept():
+    df = sample_data()
+    assert 'SOIL' in get_metal_stats(df, 'LEAD')
+    assert 'SOIL' in get_metal_stats(Dataset(df), 'LEAD')
+
+def test_missing_value_gives_no_ttest():
+    ttest = get_metal_stats(sample_data(), 'COPPER')['VEG']['historic'][2020]['washed_ttest']
+    assert ttest['t'] is None and ttest['p'] is None
@@ -0,0 +1,47 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import trends
+from trends import MIN_VALUES, TREND_COLUMNS, mann_kendall
+
+def reference_trend(times, values):
+    #one series at a time, straight from the definitions
+    keep = ~np.isnan(values)
+    times, values = times[keep], values[keep]
+    n = len(values)
+    if n < MIN_VALUES:
+        return [np.nan] * len(TREND_COLUMNS)
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    s = sum(np.sign(values[j] - values[i]) for i, j in pairs)
+    var = n * (n - 1) * (2 * n + 5)
+    for t in np.unique(values, return_counts=True)[1]:
+        var -= t * (t - 1) * (2 * t + 5)
+    var /= 18
+    z = 0 if s == 0 or var == 0 else (s - np.sign(s)) / math.sqrt(var)
+    p = math.erfc(abs(z) / math.sqrt(2))
+    slope = np.median([(values[j] - values[i]) / (times[j] - times[i]) for i, j in pairs])
+    return [s, p, slope]
+
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_matches_reference(monkeypatch, max_workers):
+    rng = np.random.default_rng(3)
+    times = np.array([2001, 2002, 2004, 2005, 2008, 2009, 2010, 2013])
+    #small integers so most series have ties, and holes so some are too short for a trend
+    values = rng.integers(0, 6, size=(60, len(times))).astype(float)
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[0] = 2
+    values[1, 2:] = np.nan
+    values[2, 3:] = np.nan
+    values[3] = np.nan
+    series = pd.DataFrame(values, index=[f'loc{i}' for i in range(len(values))], columns=times)
+    #a few rows per chunk, so the rows are split over several chunks
+    monkeypatch.setattr(trends, 'CHUNK_CELLS', 7 * len(times) ** 2)
+    result = mann_kendall(series, max_workers=max_workers)
+    expected = pd.DataFrame([reference_trend(times.astype(float), row) for row in values],
+                            index=series.index, columns=TREND_COLUMNS)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-12, atol=1e-12)
+    assert result.loc[['loc1', 'loc3']].isna().all().all()
+    assert result.loc['loc0'].tolist() == [0, 1, 0]
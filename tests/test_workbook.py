@@ -0,0 +1,53 @@
+import warnings
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import stat_functions
+from dataset import Dataset
+from stat_functions import build_zip, get_metal_stats, new_workbook, scatter, sheet_chart_jobs, siteLineChart, siteScatter, to_sheet
+from test_stats import sample_data
+
+@pytest.fixture(scope='module')
+def lead():
+    df = sample_data(rows=400)
+    return df[df['CHEMICAL_NAME'] == 'LEAD']
+
+@pytest.mark.parametrize('chart', [scatter, siteScatter, siteLineChart])
+def test_charts_take_a_frame(lead, chart):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from_frame = chart(lead, 'LEAD', dpi=20)
+        from_dataset = chart(Dataset(lead), 'LEAD', dpi=20)
+    assert set(from_frame) == set(from_dataset)
+    assert all(image.getvalue() for image in from_frame.values())
+
+def test_sheet_takes_a_frame(lead):
+    assert [name for chart, data, name in sheet_chart_jobs(lead)] == [name for chart, data, name in sheet_chart_jobs(Dataset(lead))]
+    workbook = new_workbook(BytesIO())
+    to_sheet(lead, get_metal_stats(lead, 'LEAD'), workbook, images={})
+    workbook.close()
+
+def test_zip_names_are_unique(tmp_path):
+    df = sample_data(rows=200)
+    df = df[df['CHEMICAL_NAME'].isin(['LEAD', 'ZINC'])]
+    df = df.assign(CHEMICAL_NAME=df['CHEMICAL_NAME'].map({'LEAD': 'Cr (VI)', 'ZINC': 'Cr {VI}'}).astype('category'))
+    output = str(tmp_path / 'out.zip')
+    files = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        build_zip(df, output, max_workers=1, on_file=lambda name, workbook: files.append((name, workbook)))
+    with zipfile.ZipFile(output) as archive:
+        assert sorted(archive.namelist()) == ['Cr _VI_.xlsx', 'Cr _VI__2.xlsx']
+        #each workbook is handed over as it goes into the zip
+        assert files == [(name, archive.read(name)) for name in archive.namelist()]
+
+def test_failed_zip_leaves_no_file(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('workbook failed')
+    monkeypatch.setattr(stat_functions, 'build_workbook', fail)
+    output = tmp_path / 'out.zip'
+    with pytest.raises(RuntimeError):
+        build_zip(sample_data(rows=200), str(output), max_workers=1)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from instrument import stage
+
+#Mann-Kendall trend test and Sen's slope for many series at once, e.g. every location's yearly means of a chemical.
+#Series are the rows of a frame padded with NaN where a series has no value (the location x year table from
+#location_year_means), the column labels are the times. Each chunk of rows is done with whole-array numpy over
+#all pairs of time steps, and chunks run on a thread pool (numpy releases the GIL in the array work).
+#Unlike the pearson time correlation neither needs the values to be normal or is pulled around by a single outlier.
+
+#columns of mann_kendall's result: the S statistic, its two sided p-value and the median slope per time unit
+TREND_COLUMNS = ['S', 'p', 'slope']
+#series with fewer values than this get no trend
+MIN_VALUES = 3
+#rows x time steps x time steps values per chunk, keeps the pairwise arrays to a few tens of MB
+CHUNK_CELLS = 2**20
+
+def mann_kendall(series, max_workers=None):
+    #S, p and Sen's slope (TREND_COLUMNS) for every row of series, indexed like series
+    values = series.to_numpy(dtype=float)
+    times = series.columns.to_numpy(dtype=float)
+    rows, steps = values.shape
+    chunk_rows = max(CHUNK_CELLS // max(steps * steps, 1), 1)
+    chunks = [values[start:start+chunk_rows] for start in range(0, rows, chunk_rows)]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(chunks))
+    with stage('mann_kendall', rows=rows, steps=steps, chunks=len(chunks), workers=max_workers):
+        if max_workers < 2:
+            results = [trend_chunk(chunk, times) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(trend_chunk, chunks, [times] * len(chunks)))
+    trends = np.concatenate(results) if results else np.zeros((0, len(TREND_COLUMNS)))
+    return pd.DataFrame(trends, index=series.index, columns=TREND_COLUMNS)
+
+def trend_chunk(values, times):
+    #rows x TREND_COLUMNS for one chunk of series
+    from scipy.special import ndtr
+    trends = np.full((len(values), len(TREND_COLUMNS)), np.nan)
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=1)
+    enough = n >= MIN_VALUES
+    values, valid, n = values[enough], valid[enough], n[enough]
+    #every later value minus every earlier one, NaN when either is missing
+    first, second = np.triu_indices(len(times), k=1)
+    diff = values[:, second] - values[:, first]
+    s = np.nansum(np.sign(diff), axis=1)
+    #variance of S with the tie correction. Each value counts the values equal to it (its tie group size t),
+    #so summing (t - 1)(2t + 5) over the values sums t(t - 1)(2t + 5) over the tie groups.
+    ties = (values[:, :, None] == values[:, None, :]).sum(axis=2)
+    tie_term = np.where(valid, (ties - 1) * (2 * ties + 5), 0).sum(axis=1)
+    var = (n * (n - 1) * (2 * n + 5) - tie_term) / 18
+    #continuity corrected normal approximation
+    z = np.divide(s - np.sign(s), np.sqrt(var), out=np.zeros(len(s)), where=var > 0)
+    trends[enough, 0] = s
+    trends[enough, 1] = 2 * ndtr(-np.abs(z))
+    #Sen's slope: median slope over all pairs of values
+    trends[enough, 2] = np.nanmedian(diff / (times[second] - times[first]), axis=1)
+    return trends